@@ -0,0 +1,212 @@
+import atexit
+import collections
+import glob
+import gzip
+import itertools
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+from typing import Callable, Iterator, MutableMapping
+
+try:
+    import fcntl
+except ImportError: # Windows: a single worker is the only option there
+    fcntl = None
+
+from eventmodel import StripeEvent
+
+class EventArchive:
+    """Append-only archive of accepted Stripe events, for replaying them later
+
+    Events are written by a background thread as compressed JSON lines: every batch
+    is one gzip member, so a file is also a plain `.jsonl.gz` readable with zcat. An
+    SQLite index next to the files maps event_id (and customer, type, created) to the
+    member's byte offset. Each process writes its own files, which rotate at
+    `max_bytes`; only the newest `backup_count` files are kept, except files that
+    another process still writes (each writer holds a `flock` on its file).
+
+    Events still queued when the process dies are not archived."""
+    def __init__(self, directory: str, max_bytes: int = 67108864, backup_count: int = 20, batch_size: int = 500, queue_size: int = 10000) -> None:
+        self.directory = directory
+        self.max_bytes = max_bytes # Size at which a file is rotated
+        self.backup_count = backup_count # Files kept, oldest deleted first
+        self.batch_size = batch_size # Max events per gzip member
+        self.dropped: int = 0 # Events not archived because the queue was full
+        self._queue: queue.Queue = queue.Queue(queue_size)
+        self._thread: threading.Thread | None = None
+        self._file = None
+        self._name: str | None = None
+        self._files = itertools.count(1) # Files opened by this process
+        os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(os.path.join(directory, "index.sqlite3"), isolation_level=None, check_same_thread=False, timeout=5)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS archived_events ("
+            "event_id TEXT PRIMARY KEY, "
+            "type TEXT NOT NULL, "
+            "customer TEXT, "
+            "created INTEGER NOT NULL, "
+            "file TEXT NOT NULL, "
+            "offset INTEGER NOT NULL, " # Start of the gzip member
+            "length INTEGER NOT NULL, " # Compressed size of the member
+            "line INTEGER NOT NULL)" # Line in the member
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS archived_events_created ON archived_events (created)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS archived_events_customer ON archived_events (customer, created)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS archived_events_file ON archived_events (file)")
+
+    def append(self, event: StripeEvent) -> None:
+        """Queue an event for the writer thread without blocking"""
+        if self._thread is None or not self._thread.is_alive(): # Not started yet, or closed
+            if self._thread is None:
+                atexit.register(self.close)
+            self._thread = threading.Thread(target=self._run, name="event-archive", daemon=True)
+            self._thread.start()
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self, timeout: float = 5) -> None:
+        """Write the queued events and stop the writer thread"""
+        if self._thread is not None and self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join(timeout)
+
+    def _run(self) -> None:
+        while True:
+            events = [self._queue.get()]
+            while len(events) < self.batch_size:
+                try:
+                    events.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = None in events
+            events = [event for event in events if event is not None]
+            if events:
+                try:
+                    self._write(events)
+                except Exception:
+                    logging.exception("Failed to archive %d events", len(events))
+            if stop:
+                if self._file is not None:
+                    self._file.close()
+                    self._file = None
+                return
+
+    def _write(self, events: list[StripeEvent]) -> None:
+        lines = [json.dumps(event.to_dict(), ensure_ascii=False, separators=(",", ":")) for event in events]
+        member = gzip.compress(("\n".join(lines) + "\n").encode(), compresslevel=6, mtime=0)
+        if self._file is None or self._file.tell() >= self.max_bytes:
+            self._rotate()
+        offset = self._file.tell()
+        self._file.write(member)
+        self._file.flush()
+        self._db.execute("BEGIN IMMEDIATE")
+        try:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO archived_events (event_id, type, customer, created, file, offset, length, line) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                ((event.id, event.type, event.customer, event.created, self._name, offset, len(member), line) for line, event in enumerate(events)),
+            )
+        except BaseException:
+            self._db.execute("ROLLBACK")
+            raise
+        self._db.execute("COMMIT")
+
+    def _rotate(self) -> None:
+        if self._file is not None:
+            self._file.close()
+        self._name = f"events-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{next(self._files)}.jsonl.gz"
+        self._file = open(os.path.join(self.directory, self._name), "ab")
+        if fcntl is not None:
+            fcntl.flock(self._file, fcntl.LOCK_EX | fcntl.LOCK_NB) # New file, never contended
+        files = sorted(glob.glob(os.path.join(self.directory, "events-*.jsonl.gz")), key=os.path.getmtime)
+        for path in files[:max(len(files) - self.backup_count, 0)]:
+            name = os.path.basename(path)
+            if name == self._name or self._in_use(path):
+                continue
+            self._db.execute("DELETE FROM archived_events WHERE file = ?", (name,))
+            os.remove(path)
+            logging.info("Deleted archived events in %s", name)
+
+    @staticmethod
+    def _in_use(path: str) -> bool:
+        """Whether a writer (of any process) still has the file open"""
+        if fcntl is None:
+            return False
+        try:
+            with open(path, "rb") as f:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB) # Released on close
+        except OSError:
+            return True # Locked, or already deleted
+        return False
+
+    def events(self, since: int | None = None, until: int | None = None, customers: list[str] | None = None, types: list[str] | None = None) -> Iterator[StripeEvent]:
+        """Stream the archived events matching every given filter, oldest first
+
+        `since` and `until` are Unix times (inclusive). Only the few most recently read
+        gzip members are held in memory."""
+        where, params = [], []
+        if since is not None:
+            where.append("created >= ?")
+            params.append(since)
+        if until is not None:
+            where.append("created <= ?")
+            params.append(until)
+        for column, values in (("customer", customers), ("type", types)):
+            if values:
+                where.append(f"{column} IN ({', '.join('?' * len(values))})")
+                params.extend(values)
+        rows = self._db.execute(
+            f"SELECT file, offset, length, line FROM archived_events {'WHERE ' + ' AND '.join(where) if where else ''} ORDER BY created, file, offset, line",
+            params,
+        )
+        members: collections.OrderedDict[tuple[str, int], list[bytes]] = collections.OrderedDict() # Recently read members
+        for file, offset, length, line in rows:
+            lines = members.get((file, offset))
+            if lines is None:
+                try:
+                    lines = self._read(file, offset, length)
+                except OSError as e:
+                    logging.warning("Skipping archived event in %s: %r", file, e)
+                    continue
+                members[(file, offset)] = lines
+                if len(members) > 8: # Events of several workers interleave
+                    members.popitem(last=False)
+            yield StripeEvent.from_dict(json.loads(lines[line]))
+
+    def _read(self, file: str, offset: int, length: int) -> list[bytes]:
+        with open(os.path.join(self.directory, file), "rb") as f:
+            f.seek(offset)
+            return gzip.decompress(f.read(length)).splitlines()
+
+class DryRun:
+    """Side-effect-free state for replaying events
+
+    Checkouts replayed so far shadow the stored Customer -> User map, and role
+    changes are reported instead of applied. Stripe is not asked either: checkouts
+    use the Subscription Objects of the `customer.subscription.*` events replayed
+    so far."""
+    def __init__(self, userdata: MutableMapping[str, str], report: Callable[[StripeEvent, str, str, list[str], list[str]], None]) -> None:
+        self.customers: MutableMapping[str, str] = collections.ChainMap({}, userdata) # type: ignore
+        self.report = report # (event, guild_id, user_id, add, remove)
+        self.subscriptions: dict[str, tuple[int, dict]] = {} # sub_... -> (event created, Subscription Object)
+
+    def seed_subscription(self, event: StripeEvent) -> None:
+        """Remember the Subscription Object of a `customer.subscription.*` event, unless a newer one is known"""
+        known = self.subscriptions.get(event.object["id"])
+        if known is None or known[0] <= event.created:
+            self.subscriptions[event.object["id"]] = (event.created, event.object)
+
+    def subscription(self, subscription_id: str) -> dict | None:
+        known = self.subscriptions.get(subscription_id)
+        return known[1] if known is not None else None
+
+    def member(self, user_id: str) -> dict:
+        """Stand-in Guild Member Object, as Discord is not asked during a dry run"""
+        return {"user": {"id": str(user_id), "username": str(user_id)}, "nick": None, "roles": []}
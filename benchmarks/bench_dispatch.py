@@ -0,0 +1,132 @@
+"""Micro-benchmark: table-driven status engine vs the former `match status` ladder
+
+Usage: python benchmarks/bench_dispatch.py [items per event]
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import eventmodel
+import notification
+from eventmodel import ActionType
+
+def legacy_plan(data: dict, roles: dict[str, str], member_name: str, member_id: str, event_id: str):
+    """The per-item processing of `customer.subscription.updated` before the status table"""
+    actions = []
+    embeds = []
+    for item in data["items"]["data"]:
+        product: str = item["plan"]["product"]
+
+        if product not in roles:
+            continue
+
+        role_id: str | int = roles[product] # 1234567890123
+        status: str = data["status"]
+        action: ActionType | None = None
+
+        match status:
+            case "trialing":
+                action = ActionType.ADD
+                embed = notification.DiscordEmbed()
+                embed.set_title("トライアルが開始されました！")
+                embed.set_description(f"ユーザー: {member_name}（<@{member_id}>）\nプラン: `{product}`")
+                embed.set_color(0x00ff00)
+                embed.add_field("ステータス", "トライアル中\n`customer.subscription.updated`/`trialing`", True)
+                embed.add_field("ロール状態", "付与されました。（期限が切れるとロールは削除されます。）", True)
+                embed.add_field("対象ロール", f"<@&{role_id}>", True)
+                embed.set_footer(f"event_id: {event_id}")
+                embeds.append(embed)
+            case "active":
+                action = ActionType.ADD
+                embed = notification.DiscordEmbed()
+                embed.set_title("サブスクリプションが開始されました！")
+                embed.set_description(f"ユーザー: {member_name}（<@{member_id}>）\nプラン: `{product}`")
+                embed.set_color(0x00ff00)
+                embed.add_field("ステータス", "サブスクリプションアクティブ\n`customer.subscription.updated`/`active`", True)
+                embed.add_field("ロール状態", "付与されました。（期限が切れるとロールは削除されます。）", True)
+                embed.add_field("対象ロール", f"<@&{role_id}>", True)
+                embed.set_footer(f"event_id: {event_id}")
+                embeds.append(embed)
+            case "incomplete":
+                action = ActionType.SKIP
+                embed = notification.DiscordEmbed()
+                embed.set_title("支払いを待機しています。")
+                embed.set_description(f"ユーザー: {member_name}（<@{member_id}>）\nプラン: `{product}`")
+                embed.set_color(0xffff00)
+                embed.add_field("ステータス", "購入を試みたが支払いは完了していない\n`customer.subscription.updated`/`incomplete`", True)
+                embed.add_field("ロール状態", "操作は行われません。", True)
+                embed.set_footer(f"event_id: {event_id}")
+                embeds.append(embed)
+            case "incomplete_expired":
+                action = ActionType.REMOVE
+                embed = notification.DiscordEmbed()
+                embed.set_title("支払いに失敗しました")
+                embed.set_description(f"ユーザー: {member_name}（<@{member_id}>）\nプラン: `{product}`")
+                embed.set_color(0xff0000)
+                embed.add_field("ステータス", "購入を試みたが支払いに失敗\n`customer.subscription.updated`/`incomplete_expired`", True)
+                embed.add_field("ロール状態", "削除されました。", True)
+                embed.add_field("対象ロール", f"<@&{role_id}>", True)
+                embed.set_footer(f"event_id: {event_id}")
+                embeds.append(embed)
+            case "past_due":
+                action = ActionType.REMOVE
+                embed = notification.DiscordEmbed()
+                embed.set_title("自動決済に失敗しました")
+                embed.set_description(f"ユーザー: {member_name}（<@{member_id}>）\nプラン: `{product}`")
+                embed.set_color(0xff0000)
+                embed.add_field("ステータス", "自動決済に失敗（Stripeのリトライルールに基づき再度支払いを試みる場合があります）\n`customer.subscription.updated`/`past_due`", True)
+                embed.add_field("ロール状態", "削除されました。", True)
+                embed.add_field("対象ロール", f"<@&{role_id}>", True)
+                embed.set_footer(f"event_id: {event_id}")
+                embeds.append(embed)
+            case "canceled":
+                action = ActionType.REMOVE
+                embed = notification.DiscordEmbed()
+                embed.set_title("支払いがキャンセルされました。")
+                embed.set_description(f"ユーザー: {member_name}（<@{member_id}>）\nプラン: `{product}`")
+                embed.set_color(0xff0000)
+                embed.add_field("ステータス", "支払いキャンセル\n`customer.subscription.updated`/`canceled`", True)
+                embed.add_field("ロール状態", "削除されました。", True)
+                embed.add_field("対象ロール", f"<@&{role_id}>", True)
+                embed.set_footer(f"event_id: {event_id}")
+                embeds.append(embed)
+            case "unpaid":
+                action = ActionType.REMOVE
+                embed = notification.DiscordEmbed()
+                embed.set_title("支払いは行われませんでした。")
+                embed.set_description(f"ユーザー: {member_name}（<@{member_id}>）\nプラン: `{product}`")
+                embed.set_color(0xff0000)
+                embed.add_field("ステータス", "支払いは行われませんでした。\n`customer.subscription.updated`/`unpaid`", True)
+                embed.add_field("ロール状態", "削除されました。", True)
+                embed.add_field("対象ロール", f"<@&{role_id}>", True)
+                embed.set_footer(f"event_id: {event_id}")
+                embeds.append(embed)
+            case _:
+                return ({"status": "error", "message": "Invalid payment status", "code": 202})
+
+        actions.append({
+            "action": action,
+            "role_id": role_id,
+        })
+    return actions, embeds
+
+def table_plan(data: dict, roles: dict[str, str], member_name: str, member_id: str, event_id: str):
+    return eventmodel.plan_event(eventmodel.SUBSCRIPTION_UPDATED, data["status"], data["items"]["data"], [], roles, member_name, member_id, event_id)
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    roles = {f"prod_{i}": str(100000000000000000 + i) for i in range(count)}
+    number = 20000
+    print(f"{count} item(s) per event, {number} events per run")
+    for status in ("active", "incomplete", "unpaid"):
+        data = {"status": status, "items": {"data": [{"plan": {"product": product}} for product in roles]}}
+        args = (data, roles, "member", "123456789012345678", "evt_bench")
+        assert [a["role_id"] for a in legacy_plan(*args)[0]] == [a["role_id"] for a in table_plan(*args)[0]] # type: ignore
+        legacy = min(timeit.repeat(lambda: legacy_plan(*args), number=number, repeat=5)) / number * 1e6
+        table = min(timeit.repeat(lambda: table_plan(*args), number=number, repeat=5)) / number * 1e6
+        print(f"{status:<12} legacy: {legacy:7.2f} us/event  table: {table:7.2f} us/event  ({legacy / table:.1f}x)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+"""Local stand-ins for the Discord and Stripe APIs used by the load test
+
+Discord routes answer with X-RateLimit-* headers from fixed windows per route, and
+429 responses can be injected at random on top of the real limits.
+
+Usage: python benchmarks/fake_servers.py [--port 8765] [--latency 0.05] [--ratelimit-rate 0.01]
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+
+from aiohttp import web
+
+class FakeServers:
+    def __init__(
+            self,
+            latency: float = 0.0,
+            jitter: float = 0.0,
+            ratelimit_rate: float = 0.0,
+            retry_after: float = 0.5,
+            bucket_limit: int = 50,
+            bucket_window: float = 1.0
+        ) -> None:
+        self.latency = latency # Seconds added to every response
+        self.jitter = jitter # Max random seconds added on top of latency
+        self.ratelimit_rate = ratelimit_rate # Probability of an injected 429
+        self.retry_after = retry_after # retry_after of injected 429s
+        self.bucket_limit = bucket_limit # Requests per window per Discord route
+        self.bucket_window = bucket_window # Seconds per rate limit window
+        self.members: dict[str, dict] = {} # user_id -> Guild Member Object
+        self.subscriptions: dict[str, dict] = {} # sub_... -> Subscription Object
+        self.role_changes: list[tuple[float, str, frozenset[str]]] = [] # (monotonic time, user_id, roles)
+        self.notifications = 0 # Embeds received by the webhook
+        self.requests: dict[str, int] = {} # route -> count
+        self.ratelimited = 0 # 429 responses sent
+        self._windows: dict[str, tuple[float, int]] = {} # route -> (window end, used)
+        self._runner: web.AppRunner | None = None
+
+    def member(self, user_id: str) -> dict:
+        return self.members.setdefault(user_id, {"user": {"id": user_id, "username": f"user{user_id}"}, "nick": None, "roles": []})
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get("/api/guilds/{guild_id}/members", self.list_members)
+        app.router.add_get("/api/guilds/{guild_id}/members/{user_id}", self.get_member)
+        app.router.add_patch("/api/guilds/{guild_id}/members/{user_id}", self.modify_member)
+        app.router.add_post("/api/webhooks/{webhook_id}/{webhook_token}", self.execute_webhook)
+        app.router.add_get("/v1/subscriptions/{subscription_id}", self.retrieve_subscription)
+        app.router.add_get("/v1/subscriptions", self.list_subscriptions)
+        app.router.add_get("/v1/events", self.list_events)
+        return app
+
+    async def start(self, host: str = "127.0.0.1", port: int = 8765) -> None:
+        self._runner = web.AppRunner(self.app(), access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    async def _delay(self) -> None:
+        if self.latency or self.jitter:
+            await asyncio.sleep(self.latency + random.uniform(0, self.jitter))
+
+    def _ratelimit(self, route: str) -> tuple[dict, web.Response | None]:
+        """Headers of the route's window, and a 429 response if the request is limited"""
+        self.requests[route] = self.requests.get(route, 0) + 1
+        now = time.monotonic()
+        window_end, used = self._windows.get(route, (0.0, 0))
+        if window_end <= now:
+            window_end, used = now + self.bucket_window, 0
+        limited = used >= self.bucket_limit
+        if not limited:
+            used += 1
+        self._windows[route] = (window_end, used)
+        headers = {
+            "X-RateLimit-Bucket": route,
+            "X-RateLimit-Limit": str(self.bucket_limit),
+            "X-RateLimit-Remaining": str(self.bucket_limit - used),
+            "X-RateLimit-Reset-After": f"{window_end - now:.3f}",
+        }
+        retry_after = window_end - now if limited else None
+        if retry_after is None and random.random() < self.ratelimit_rate:
+            retry_after = self.retry_after
+        if retry_after is None:
+            return headers, None
+        self.ratelimited += 1
+        headers["Retry-After"] = f"{retry_after:.3f}"
+        headers["X-RateLimit-Scope"] = "user"
+        return headers, web.json_response({"message": "You are being rate limited.", "retry_after": retry_after, "global": False}, status=429, headers=headers)
+
+    async def get_member(self, request: web.Request) -> web.Response:
+        await self._delay()
+        headers, limited = self._ratelimit("get_member")
+        if limited:
+            return limited
+        return web.json_response(self.member(request.match_info["user_id"]), headers=headers)
+
+    async def list_members(self, request: web.Request) -> web.Response:
+        await self._delay()
+        headers, limited = self._ratelimit("list_members")
+        if limited:
+            return limited
+        after, limit = int(request.query.get("after", "0")), int(request.query.get("limit", "1"))
+        members = sorted((m for m in self.members.values() if int(m["user"]["id"]) > after), key=lambda m: int(m["user"]["id"]))
+        return web.json_response(members[:limit], headers=headers)
+
+    async def modify_member(self, request: web.Request) -> web.Response:
+        await self._delay()
+        headers, limited = self._ratelimit("modify_member")
+        if limited:
+            return limited
+        member = self.member(request.match_info["user_id"])
+        body = await request.json()
+        if "roles" in body:
+            member["roles"] = list(body["roles"])
+            self.role_changes.append((time.monotonic(), member["user"]["id"], frozenset(member["roles"])))
+        return web.json_response(member, headers=headers)
+
+    async def execute_webhook(self, request: web.Request) -> web.Response:
+        await self._delay()
+        headers, limited = self._ratelimit("execute_webhook")
+        if limited:
+            return limited
+        body = await request.json()
+        self.notifications += len(body.get("embeds", [])) or 1
+        return web.Response(status=204, headers=headers)
+
+    async def retrieve_subscription(self, request: web.Request) -> web.Response:
+        await self._delay()
+        self.requests["retrieve_subscription"] = self.requests.get("retrieve_subscription", 0) + 1
+        subscription = self.subscriptions.get(request.match_info["subscription_id"])
+        if subscription is None:
+            return web.json_response({"error": {"type": "invalid_request_error", "message": "No such subscription"}}, status=404)
+        return web.json_response(subscription)
+
+    async def list_subscriptions(self, request: web.Request) -> web.Response:
+        await self._delay()
+        status = request.query.get("status", "active")
+        data = [s for s in self.subscriptions.values() if status == "all" or s["status"] == status]
+        if "starting_after" in request.query:
+            ids = [s["id"] for s in data]
+            data = data[ids.index(request.query["starting_after"]) + 1:] if request.query["starting_after"] in ids else []
+        limit = int(request.query.get("limit", "10"))
+        return web.json_response({"object": "list", "url": "/v1/subscriptions", "has_more": len(data) > limit, "data": data[:limit]})
+
+    async def list_events(self, request: web.Request) -> web.Response:
+        await self._delay()
+        return web.json_response({"object": "list", "url": "/v1/events", "has_more": False, "data": []})
+
+async def serve(args: argparse.Namespace) -> None:
+    servers = FakeServers(args.latency, args.jitter, args.ratelimit_rate, args.retry_after, args.bucket_limit, args.bucket_window)
+    await servers.start(port=args.port)
+    print(f"Fake Discord: http://127.0.0.1:{args.port}/api, fake Stripe: http://127.0.0.1:{args.port}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        print(json.dumps({"requests": servers.requests, "ratelimited": servers.ratelimited, "notifications": servers.notifications}))
+        await servers.stop()
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every fake response")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Max random seconds added on top of --latency")
+    parser.add_argument("--ratelimit-rate", type=float, default=0.0, help="Probability of an injected Discord 429")
+    parser.add_argument("--retry-after", type=float, default=0.5, help="retry_after of injected 429s")
+    parser.add_argument("--bucket-limit", type=int, default=50, help="Discord requests per window per route")
+    parser.add_argument("--bucket-window", type=float, default=1.0, help="Seconds per Discord rate limit window")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=8765)
+    add_arguments(parser)
+    try:
+        asyncio.run(serve(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,246 @@
+"""Load test: replay event mixes against the webhook with local Discord and Stripe stand-ins
+
+Starts the fake servers, runs main.py in a temporary directory with a generated
+config.json pointing at them, and sends
+  1. a checkout burst (one `checkout.session.completed` per customer),
+  2. renewal waves (one `customer.subscription.updated` per customer, switching plans),
+  3. duplicate resends of a share of those events,
+at the target rate, plus optional extra copies with forged signatures. Reports ack latency, role-applied latency, throughput and memory.
+
+Usage: python benchmarks/loadtest.py [--rate 100] [--customers 500] [--waves 2] [--duplicates 0.1] [--forged 0.0]
+                                     [--latency 0.05] [--ratelimit-rate 0.01] [--async-webhook]
+                                     [--config '{"WORKER_CONCURRENCY": 16}'] [--json]
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+import aiohttp
+
+from fake_servers import FakeServers, add_arguments
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import eventmodel
+
+WEBHOOK_SECRET = "whsec_loadtest"
+PRODUCTS = {"prod_A": "111", "prod_B": "222"} # Product -> Role
+USER_ID_BASE = 100000
+
+def rss_kib(pid: int) -> int | None:
+    """Resident set size of a process and its children, e.g. Sanic workers (Linux only)"""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            rss = next((int(line.split()[1]) for line in f if line.startswith("VmRSS:")), 0)
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            children = [int(child) for child in f.read().split()]
+    except OSError:
+        return None
+    return rss + sum(rss_kib(child) or 0 for child in children)
+
+def percentile(values: list[float], p: float) -> float:
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+def build_events(servers: FakeServers, customers: int, waves: int, duplicates: float) -> list[tuple[dict, str | None, frozenset[str] | None]]:
+    """(event, user_id, roles expected after it) in send order. Resends expect no change"""
+    events = []
+    created = int(time.time())
+    for i in range(customers):
+        customer, user_id = f"cus_{i}", str(USER_ID_BASE + i)
+        servers.subscriptions[f"sub_{i}"] = {"id": f"sub_{i}", "object": "subscription", "customer": customer, "status": "active", "items": {"object": "list", "data": [{"plan": {"product": "prod_A"}}]}}
+        servers.member(user_id)
+        session = {"id": f"cs_{i}", "object": "checkout.session", "customer": customer, "subscription": f"sub_{i}", "custom_fields": [{"numeric": {"value": user_id}}]}
+        events.append(({"id": f"evt_checkout_{i}", "object": "event", "type": "checkout.session.completed", "created": created, "data": {"object": session}}, user_id, frozenset({PRODUCTS["prod_A"]})))
+    for wave in range(waves):
+        created += 1
+        product, previous = ("prod_B", "prod_A") if wave % 2 == 0 else ("prod_A", "prod_B")
+        for i in range(customers):
+            subscription = {"id": f"sub_{i}", "object": "subscription", "customer": f"cus_{i}", "status": "active", "items": {"object": "list", "data": [{"plan": {"product": product}}]}}
+            previous_attributes = {"items": {"object": "list", "data": [{"plan": {"product": previous}}]}}
+            events.append(({"id": f"evt_renewal_{wave}_{i}", "object": "event", "type": "customer.subscription.updated", "created": created, "data": {"object": subscription, "previous_attributes": previous_attributes}}, str(USER_ID_BASE + i), frozenset({PRODUCTS[product]})))
+    # Resend a share of the events a little later, like Stripe does after a slow or failed ack
+    mixed: list[tuple[dict, str | None, frozenset[str] | None]] = []
+    resends: dict[int, list[dict]] = {} # position -> events to resend there
+    for n, entry in enumerate(events):
+        mixed.append(entry)
+        mixed.extend((event, None, None) for event in resends.pop(n, []))
+        if random.random() < duplicates:
+            resends.setdefault(n + random.randint(1, 50), []).append(entry[0])
+    mixed.extend((event, None, None) for pending in resends.values() for event in pending)
+    return mixed
+
+async def wait_ready(session: aiohttp.ClientSession, url: str, process: subprocess.Popen, timeout: float = 30) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"main.py exited with {process.returncode}")
+        try:
+            async with session.get(url) as resp:
+                if resp.status < 500:
+                    return
+        except aiohttp.ClientError:
+            pass
+        await asyncio.sleep(0.2)
+    raise RuntimeError("main.py did not start in time")
+
+async def run(args: argparse.Namespace) -> dict:
+    servers = FakeServers(args.latency, args.jitter, args.ratelimit_rate, args.retry_after, args.bucket_limit, args.bucket_window)
+    await servers.start(port=args.fake_port)
+    fake_base = f"http://127.0.0.1:{args.fake_port}"
+    events = build_events(servers, args.customers, args.waves, args.duplicates)
+
+    workdir = tempfile.mkdtemp(prefix="dinosaur-loadtest-")
+    config = {
+        "DISCORD_TOKEN": "loadtest",
+        "STRIPE_API_KEY": "sk_test_loadtest",
+        "SERVER_PORT": args.port,
+        "DISCORD_GUILD_ID": "1",
+        "ROLES": PRODUCTS,
+        "NOTIFY_WEBHOOK": f"{fake_base}/api/webhooks/1/loadtest",
+        "ASYNC_WEBHOOK": args.async_webhook,
+        "WORKER_QUEUE_SIZE": max(1000, len(events)),
+        "EVENT_CATCHUP": False,
+        "DISCORD_API_BASE": f"{fake_base}/api",
+        "STRIPE_API_BASE": fake_base,
+        "STRIPE_WEBHOOK_SECRET": WEBHOOK_SECRET,
+    }
+    config.update(json.loads(args.config))
+    with open(os.path.join(workdir, "config.json"), "w") as f:
+        json.dump(config, f)
+    log = open(os.path.join(workdir, "stdout.log"), "w")
+    process = subprocess.Popen([sys.executable, os.path.join(ROOT, "main.py")], cwd=workdir, stdout=log, stderr=subprocess.STDOUT)
+
+    webhook_url = f"http://127.0.0.1:{args.port}/webhook"
+    acks: list[float] = []
+    codes: dict[int, int] = {}
+    sent: list[tuple[float, str, frozenset[str]]] = [] # (send time, user_id, expected roles)
+    rss: list[int] = []
+    try:
+        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0)) as session:
+            await wait_ready(session, f"http://127.0.0.1:{args.port}/metrics", process)
+            rss_start = rss_kib(process.pid)
+
+            async def send(event: dict, user_id: str | None, expected: frozenset[str] | None, forged: bool = False) -> None:
+                body = json.dumps(event).encode()
+                secret = b"whsec_forged" if forged else WEBHOOK_SECRET.encode()
+                headers = {"Content-Type": "application/json", "Stripe-Signature": eventmodel.sign_payload(body, secret)}
+                start = time.monotonic()
+                if user_id is not None and expected is not None and not forged:
+                    sent.append((start, user_id, expected))
+                async with session.post(webhook_url, data=body, headers=headers) as resp:
+                    result = await resp.json()
+                acks.append(time.monotonic() - start)
+                codes[result.get("code", resp.status)] = codes.get(result.get("code", resp.status), 0) + 1
+
+            async def sample_memory() -> None:
+                while True:
+                    value = rss_kib(process.pid)
+                    if value is not None:
+                        rss.append(value)
+                    await asyncio.sleep(0.5)
+
+            sampler = asyncio.create_task(sample_memory())
+            start = time.monotonic()
+            tasks = []
+            for n, (event, user_id, expected) in enumerate(events):
+                delay = start + n / args.rate - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                tasks.append(asyncio.create_task(send(event, user_id, expected)))
+                if random.random() < args.forged:
+                    tasks.append(asyncio.create_task(send(event, None, None, forged=True)))
+            await asyncio.gather(*tasks)
+            send_duration = time.monotonic() - start
+
+            # Wait for the last expected role state of every member
+            final = {user_id: expected for _, user_id, expected in sent}
+            deadline = time.monotonic() + args.drain_timeout
+            while time.monotonic() < deadline and any(frozenset(servers.member(u)["roles"]) != r for u, r in final.items()):
+                await asyncio.sleep(0.1)
+            total_duration = time.monotonic() - start
+            sampler.cancel()
+            rss_end = rss_kib(process.pid)
+    finally:
+        process.send_signal(signal.SIGINT)
+        try:
+            process.wait(10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+        log.close()
+        await servers.stop()
+
+    # Role-applied latency: first change of the member to the expected roles after the event was sent
+    changes: dict[str, list[tuple[float, frozenset[str]]]] = {}
+    for at, user_id, roles in servers.role_changes:
+        changes.setdefault(user_id, []).append((at, roles))
+    applied, missing = [], 0
+    for sent_at, user_id, expected in sent:
+        at = next((at for at, roles in changes.get(user_id, []) if at >= sent_at and roles == expected), None)
+        if at is None:
+            missing += 1
+        else:
+            applied.append(at - sent_at)
+
+    return {
+        "events": len(events),
+        "rate": args.rate,
+        "codes": {str(code): count for code, count in sorted(codes.items())},
+        "ack_p50_ms": percentile(acks, 50) * 1000,
+        "ack_p99_ms": percentile(acks, 99) * 1000,
+        "applied_p50_ms": percentile(applied, 50) * 1000,
+        "applied_p99_ms": percentile(applied, 99) * 1000,
+        "applied_missing": missing,
+        "ack_throughput": len(acks) / send_duration,
+        "applied_throughput": len(applied) / total_duration,
+        "discord_requests": servers.requests,
+        "discord_429": servers.ratelimited,
+        "notifications": servers.notifications,
+        "rss_start_kib": rss_start,
+        "rss_end_kib": rss_end,
+        "rss_peak_kib": max(rss) if rss else None,
+        "workdir": workdir,
+    }
+
+def report(result: dict) -> None:
+    print(f"events: {result['events']} at {result['rate']}/s, result codes: {result['codes']}")
+    print(f"ack latency: p50 {result['ack_p50_ms']:.1f} ms, p99 {result['ack_p99_ms']:.1f} ms, {result['ack_throughput']:.1f} events/s")
+    print(f"role applied latency: p50 {result['applied_p50_ms']:.1f} ms, p99 {result['applied_p99_ms']:.1f} ms, {result['applied_throughput']:.1f} changes/s, {result['applied_missing']} never applied")
+    print(f"discord: {result['discord_requests']}, {result['discord_429']} x 429, {result['notifications']} embeds")
+    if result["rss_start_kib"] is not None:
+        print(f"memory (RSS): {result['rss_start_kib'] / 1024:.1f} MiB -> {result['rss_end_kib'] / 1024:.1f} MiB (peak {result['rss_peak_kib'] / 1024:.1f} MiB)")
+    print(f"logs: {result['workdir']}")
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rate", type=float, default=100, help="Events sent per second")
+    parser.add_argument("--customers", type=int, default=500, help="Customers in the checkout burst")
+    parser.add_argument("--waves", type=int, default=2, help="Renewal waves after the checkout burst")
+    parser.add_argument("--duplicates", type=float, default=0.1, help="Share of events resent")
+    parser.add_argument("--forged", type=float, default=0.0, help="Share of events also sent as an extra copy with an invalid signature")
+    parser.add_argument("--async-webhook", action="store_true", help="Run with ASYNC_WEBHOOK")
+    parser.add_argument("--config", default="{}", help="JSON merged into the generated config.json")
+    parser.add_argument("--port", type=int, default=5599, help="Port of the service under test")
+    parser.add_argument("--fake-port", type=int, default=8765, help="Port of the fake servers")
+    parser.add_argument("--drain-timeout", type=float, default=60, help="Seconds to wait for role changes after the last event")
+    parser.add_argument("--json", action="store_true", help="Print the result as JSON")
+    add_arguments(parser)
+    args = parser.parse_args()
+    result = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps(result, indent=4))
+    else:
+        report(result)
+
+if __name__ == "__main__":
+    main()
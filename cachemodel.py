@@ -0,0 +1,71 @@
+import asyncio
+import collections
+import time
+from typing import Any, Awaitable, Callable, Hashable
+
+class AsyncTTLCache:
+    """Size-bounded LRU cache with TTL for dinosaur-stripeconnect
+
+    Concurrent `get_or_fetch` calls for the same key share one in-flight fetch."""
+    def __init__(self, ttl: float = 60, max_size: int = 10000) -> None:
+        self.ttl = ttl # Seconds until an entry expires
+        self.max_size = max_size # Max number of entries
+        self._data: collections.OrderedDict[Hashable, tuple[float, Any]] = collections.OrderedDict() # key -> (expires_at, value)
+        self._inflight: dict[Hashable, asyncio.Future] = {}
+        self.hits: int = 0
+        self.misses: int = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._data.get(key)
+        if entry is None:
+            return default
+        if entry[0] < time.monotonic():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return entry[1]
+
+    def set(self, key: Hashable, value: Any, ttl: float | None = None) -> None:
+        self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def invalidate(self, key: Hashable) -> None:
+        """Drop an entry (and forget an in-flight fetch, so its result is not stored)"""
+        self._data.pop(key, None)
+        self._inflight.pop(key, None)
+
+    async def get_or_fetch(self, key: Hashable, fetch: Callable[[], Awaitable[Any]]) -> Any:
+        """Return the cached value, or fetch it (None results are not cached)"""
+        _missing = object()
+        value = self.get(key, _missing)
+        if value is not _missing:
+            self.hits += 1
+            return value
+        future = self._inflight.get(key)
+        if future is not None:
+            self.hits += 1
+            return await asyncio.shield(future)
+        self.misses += 1
+        future = self._inflight[key] = asyncio.get_running_loop().create_future()
+        try:
+            value = await fetch()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            future.exception() # Mark as retrieved when nobody else was waiting
+            raise
+        else:
+            future.set_result(value)
+            if value is not None and self._inflight.get(key) is future:
+                self.set(key, value)
+            return value
+        finally:
+            if self._inflight.get(key) is future:
+                del self._inflight[key]
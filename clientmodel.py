@@ -1,67 +1,399 @@
 import asyncio
 import aiohttp
+import contextlib
 import logging
+import sqlite3
+import time
+from typing import Any, AsyncIterator
+
+import cachemodel
+import metricsmodel
+
+def create_session(limit: int = 100, dns_cache_ttl: int = 300, keepalive_timeout: float = 60) -> aiohttp.ClientSession:
+    """Create a keep-alive HTTP session shared by the Discord API client and notifications"""
+    connector = aiohttp.TCPConnector(limit=limit, ttl_dns_cache=dns_cache_ttl, keepalive_timeout=keepalive_timeout)
+    return aiohttp.ClientSession(connector=connector)
+
+MODIFY_ROLES_REASON = "Subscription with Stripe has been updated. (dinosaur-stripeconnect)"
+
+class RateLimitBucket:
+    """State of a single Discord rate limit bucket"""
+    def __init__(self) -> None:
+        self.limit: int | None = None # X-RateLimit-Limit
+        self.remaining: int | None = None # X-RateLimit-Remaining (None = unknown)
+        self.reset_at: float = 0.0 # time.monotonic() when the bucket resets
+        self.reset_after: float = 0.0 # Longest X-RateLimit-Reset-After seen (window length)
+        self.probing: bool = False # A request is in flight while the limits are unknown
+        self.wakeup: asyncio.Future | None = None # Resolved by the next update(), shared by every waiter
+
+class RateLimiter:
+    """Discord rate limit scheduler
+
+    Tracks the per-route buckets and the global limit from the `X-RateLimit-*` and
+    `Retry-After` headers, so that every request is sent as soon as it is allowed.
+    Share one instance between everything that talks to the same bot token."""
+    def __init__(self) -> None:
+        self._hashes: dict[str, str] = {} # route -> X-RateLimit-Bucket
+        self._buckets: dict[str, RateLimitBucket] = {}
+        self._global_reset_at: float = 0.0
+        self.hits: int = 0 # Number of 429 responses
+
+    def get_bucket(self, route: str, major: str) -> RateLimitBucket:
+        bucket_hash = self._hashes.get(route, route)
+        key = f"{bucket_hash}:{major}"
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = RateLimitBucket()
+        return bucket
+
+    def _wait_time(self, bucket: RateLimitBucket) -> float:
+        now = time.monotonic()
+        if self._global_reset_at > now:
+            return self._global_reset_at - now
+        if bucket.reset_at <= now and bucket.limit is not None:
+            bucket.remaining = bucket.limit # Assume a new window until a response tells otherwise
+            bucket.reset_at = now + bucket.reset_after
+        if bucket.remaining is None:
+            return 1.0 if bucket.probing else 0.0 # Woken up early by update()
+        if bucket.remaining <= 0:
+            return bucket.reset_at - now
+        return 0.0
+
+    async def acquire(self, route: str, major: str) -> RateLimitBucket:
+        """Wait until a request on the route is allowed"""
+        bucket = self.get_bucket(route, major)
+        # No lock: bucket state is only changed between awaits. asyncio.wait() leaves the
+        # shared future alone on timeout, unlike wait_for() on a Condition.
+        while (wait := self._wait_time(bucket)) > 0:
+            if bucket.wakeup is None or bucket.wakeup.done():
+                bucket.wakeup = asyncio.get_running_loop().create_future()
+            await asyncio.wait((bucket.wakeup,), timeout=wait)
+        if bucket.remaining is None:
+            bucket.probing = True # Let one request through to learn the limits
+        else:
+            bucket.remaining -= 1
+        return bucket
+
+    async def update(self, route: str, major: str, bucket: RateLimitBucket, status: int | None, headers: Any = None, body: Any = None) -> float | None:
+        """Update the bucket from a response. Returns the delay before retrying if rate limited"""
+        now = time.monotonic()
+        headers = headers or {}
+        retry_after = None
+        if "X-RateLimit-Bucket" in headers and route not in self._hashes:
+            self._hashes[route] = headers["X-RateLimit-Bucket"]
+            self._buckets.setdefault(f"{self._hashes[route]}:{major}", bucket) # Keep what we learned so far
+        if "X-RateLimit-Remaining" in headers:
+            remaining = int(headers["X-RateLimit-Remaining"])
+            if bucket.remaining is not None and bucket.reset_at > now:
+                remaining = min(remaining, bucket.remaining) # Other requests in this window may still be in flight
+            bucket.limit = int(headers.get("X-RateLimit-Limit", 1))
+            bucket.remaining = remaining
+            reset_after = float(headers.get("X-RateLimit-Reset-After", 1))
+            bucket.reset_after = max(bucket.reset_after, reset_after)
+            bucket.reset_at = now + reset_after
+        if status == 429:
+            self.hits += 1
+            body = body if isinstance(body, dict) else {}
+            retry_after = float(body.get("retry_after") or headers.get("Retry-After") or 1)
+            if body.get("global") or headers.get("X-RateLimit-Global") or headers.get("X-RateLimit-Scope") == "global":
+                self._global_reset_at = now + retry_after
+            else:
+                bucket.remaining = 0
+                bucket.reset_at = max(bucket.reset_at, now + retry_after)
+            logging.warning("Rate limited on %s (retry after %.2fs)", route, retry_after)
+        bucket.probing = False
+        if bucket.wakeup is not None and not bucket.wakeup.done():
+            bucket.wakeup.set_result(None)
+        return retry_after
+
+class SharedRateLimiter(RateLimiter):
+    """Discord rate limit scheduler whose budgets are shared through SQLite
+
+    Every process using the same database (e.g. Sanic workers with the same bot token)
+    spends from the same buckets and sees the same global limit. Times are wall clock
+    (`time.time()`) as they are compared across processes.
+
+    Waiting requests sleep until the reset time they read, and only a request that can
+    be sent takes the write lock (for a single conditional UPDATE)."""
+    def __init__(self, path: str, probe_timeout: float = 1.0) -> None:
+        super().__init__()
+        self.path = path
+        self.probe_timeout = probe_timeout # Max seconds to wait for the response of a request probing an unknown bucket
+        self._db = sqlite3.connect(path, isolation_level=None, check_same_thread=False, timeout=5)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS ratelimit_buckets ("
+            "key TEXT PRIMARY KEY, "
+            "\"limit\" INTEGER, "
+            "remaining INTEGER, "
+            "reset_at REAL NOT NULL DEFAULT 0, "
+            "reset_after REAL NOT NULL DEFAULT 0) WITHOUT ROWID"
+        )
+        self._db.execute("CREATE TABLE IF NOT EXISTS ratelimit_routes (route TEXT PRIMARY KEY, bucket TEXT NOT NULL) WITHOUT ROWID")
+
+    def _key(self, route: str, major: str) -> str:
+        bucket_hash = self._hashes.get(route)
+        if bucket_hash is None:
+            row = self._db.execute("SELECT bucket FROM ratelimit_routes WHERE route = ?", (route,)).fetchone()
+            if row is None:
+                return f"{route}:{major}"
+            bucket_hash = self._hashes[route] = row[0] # Learned by another process
+        return f"{bucket_hash}:{major}"
+
+    def _reserve(self, key: str) -> float | None:
+        """Take one request from the shared bucket. Returns the seconds to wait, or None if unknown"""
+        while True:
+            now = time.time()
+            rows = {row[0]: row[1:] for row in self._db.execute("SELECT key, \"limit\", remaining, reset_at, reset_after FROM ratelimit_buckets WHERE key IN ('global', ?)", (key,))}
+            if "global" in rows and rows["global"][2] > now:
+                return rows["global"][2] - now
+            if key not in rows:
+                return None
+            limit, remaining, reset_at, reset_after = rows[key]
+            if reset_at > now:
+                if remaining is None:
+                    return None
+                if remaining <= 0:
+                    return reset_at - now
+                cursor = self._db.execute("UPDATE ratelimit_buckets SET remaining = remaining - 1 WHERE key = ? AND reset_at > ? AND remaining > 0", (key, now))
+            else:
+                if limit is None:
+                    return None
+                # Assume a new window until a response tells otherwise
+                cursor = self._db.execute("UPDATE ratelimit_buckets SET remaining = \"limit\" - 1, reset_at = ? WHERE key = ? AND reset_at <= ?", (now + reset_after, key, now))
+            if cursor.rowcount:
+                return 0.0
+            # Another process changed the bucket since it was read: read it again
+
+    async def acquire(self, route: str, major: str) -> RateLimitBucket:
+        bucket = self.get_bucket(route, major) # Local state, for probing unknown buckets in this process
+        while True:
+            wait = self._reserve(self._key(route, major))
+            if wait is None:
+                if not bucket.probing:
+                    bucket.probing = True # Let one request of this process through to learn the limits
+                    return bucket
+                wait = self.probe_timeout # Woken up early by update()
+            if wait <= 0:
+                return bucket
+            if bucket.wakeup is None or bucket.wakeup.done():
+                bucket.wakeup = asyncio.get_running_loop().create_future()
+            await asyncio.wait((bucket.wakeup,), timeout=wait)
+
+    async def update(self, route: str, major: str, bucket: RateLimitBucket, status: int | None, headers: Any = None, body: Any = None) -> float | None:
+        now = time.time()
+        headers = headers or {}
+        retry_after = None
+        if "X-RateLimit-Bucket" in headers and route not in self._hashes:
+            self._hashes[route] = headers["X-RateLimit-Bucket"]
+            self._db.execute("INSERT OR IGNORE INTO ratelimit_routes (route, bucket) VALUES (?, ?)", (route, headers["X-RateLimit-Bucket"]))
+        key = self._key(route, major)
+        self._db.execute("BEGIN IMMEDIATE")
+        try:
+            row = self._db.execute("SELECT remaining, reset_at, reset_after FROM ratelimit_buckets WHERE key = ?", (key,)).fetchone()
+            remaining, reset_at, reset_after = row if row is not None else (None, 0.0, 0.0)
+            limit = None
+            if "X-RateLimit-Remaining" in headers:
+                header_remaining = int(headers["X-RateLimit-Remaining"])
+                # Other requests in this window may still be in flight
+                remaining = min(header_remaining, remaining) if remaining is not None and reset_at > now else header_remaining
+                limit = int(headers.get("X-RateLimit-Limit", 1))
+                header_reset_after = float(headers.get("X-RateLimit-Reset-After", 1))
+                reset_after = max(reset_after, header_reset_after)
+                reset_at = now + header_reset_after
+            if status == 429:
+                self.hits += 1
+                body = body if isinstance(body, dict) else {}
+                retry_after = float(body.get("retry_after") or headers.get("Retry-After") or 1)
+                if body.get("global") or headers.get("X-RateLimit-Global") or headers.get("X-RateLimit-Scope") == "global":
+                    self._db.execute(
+                        "INSERT INTO ratelimit_buckets (key, reset_at) VALUES ('global', ?) ON CONFLICT (key) DO UPDATE SET reset_at = max(reset_at, excluded.reset_at)",
+                        (now + retry_after,),
+                    )
+                else:
+                    remaining = 0
+                    reset_at = max(reset_at, now + retry_after)
+                logging.warning("Rate limited on %s (retry after %.2fs)", route, retry_after)
+            if limit is not None or status == 429:
+                self._db.execute(
+                    "INSERT INTO ratelimit_buckets (key, \"limit\", remaining, reset_at, reset_after) VALUES (?, ?, ?, ?, ?) "
+                    "ON CONFLICT (key) DO UPDATE SET \"limit\" = coalesce(excluded.\"limit\", \"limit\"), remaining = excluded.remaining, reset_at = excluded.reset_at, reset_after = excluded.reset_after",
+                    (key, limit, remaining, reset_at, reset_after),
+                )
+        finally:
+            self._db.execute("COMMIT")
+        bucket.probing = False
+        if bucket.wakeup is not None and not bucket.wakeup.done():
+            bucket.wakeup.set_result(None)
+        return retry_after
 
 class Client:
     """Discord API Client for dinosaur-stripeconnect"""
-    def __init__(self, token: str, guild_id: int | str, api_version: int | None = None) -> None:
+    def __init__(
+            self,
+            token: str,
+            guild_id: int | str,
+            api_version: int | None = None,
+            session: aiohttp.ClientSession | None = None,
+            ratelimit: RateLimiter | None = None,
+            max_retries: int = 5,
+            member_cache: cachemodel.AsyncTTLCache | None = None,
+            api_base: str = "https://discord.com/api",
+            concurrency: int | None = None
+        ) -> None:
         # self.app = app
         self.token = token # Discord Bot Token
         self.guild_id = str(guild_id) # Discord Guild ID
         self._content_type = "application/json" # HTTP Request Content-Type
         self._authorization = f"Bot {self.token}" # HTTP Request Authorization
-        self._base_url = "https://discord.com/api" # Discord API Base URL
+        self._base_url = api_base.rstrip("/") # Discord API Base URL
         self.api_version: int | None = api_version # Discord API Version
         self._api_url = f"{self._base_url}/v{self.api_version}" if self.api_version else self._base_url # Discord API URL
+        self.session: aiohttp.ClientSession | None = session # Shared HTTP Session (see create_session)
+        self.ratelimit = ratelimit or RateLimiter() # Shared by every request of this client
+        self.max_retries = max_retries # Retries on 429 Too Many Requests
+        self.members = member_cache or cachemodel.AsyncTTLCache() # user_id -> Guild Member Object
+        self._slots = asyncio.Semaphore(concurrency) if concurrency else None # Max requests in flight (including rate limit waits)
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self.session is None or self.session.closed:
+            self.session = create_session()
+        return self.session
+
+    async def close(self) -> None:
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+
+    async def _request(self, method: str, route: str, reason: str | None = None, json: Any = None, query: dict | None = None, **params: Any) -> tuple[int, Any]:
+        """Send a request to the Discord API through the rate limiter
+
+        `route` is the path template (e.g. `/guilds/{guild_id}/members/{user_id}`), which
+        identifies the rate limit bucket together with the guild. Returns (status, body)."""
+        route_key = f"{method} {route}"
+        url = self._api_url + route.format(guild_id=self.guild_id, **params)
+        headers = {"Authorization": self._authorization}
+        if json is not None:
+            headers["Content-Type"] = self._content_type
+        if reason is not None:
+            headers["X-Audit-Log-Reason"] = reason
+        status, data = 0, None
+        async with self._slots or contextlib.nullcontext():
+            for _ in range(self.max_retries + 1):
+                bucket = await self.ratelimit.acquire(route_key, self.guild_id)
+                resp_headers = None
+                try:
+                    async with self._get_session().request(method, url, headers=headers, json=json, params=query) as resp:
+                        status, resp_headers = resp.status, resp.headers
+                        data = await resp.json() if resp.content_type == "application/json" else None
+                finally:
+                    retry_after = await self.ratelimit.update(route_key, self.guild_id, bucket, status, resp_headers, data)
+                if retry_after is None:
+                    break
+        return status, data
 
     async def _add_role(self, member_id: str | int, role_id: str | int, reason: str = "Subscription with Stripe is now active. (dinosaur-stripeconnect)"):
-        headers = {
-            "Authorization": self._authorization,
-            "Content-Type": self._content_type,
-            "X-Audit-Log-Reason": reason
-        }
-        async with aiohttp.ClientSession() as sess:
-            async with sess.put(f"{self._api_url}/guilds/{self.guild_id}/members/{member_id}/roles/{role_id}", headers=headers) as resp:
-                print("Add Role (Discord API)", resp.status)
-                if resp.status == 204:
-                    return True
-                else:
-                    return False
+        status, _ = await self._request("PUT", "/guilds/{guild_id}/members/{member_id}/roles/{role_id}", reason=reason, member_id=member_id, role_id=role_id)
+        logging.info("Add Role (Discord API) %s", status)
+        return status == 204
 
     async def add_roles(self, member_id: str | int, role_ids: str | int | list[str] | list[int], reason: str = "Subscription with Stripe is now active. (dinosaur-stripeconnect)"):
         if isinstance(role_ids, str) or isinstance(role_ids, int):
             role_ids: list[str] | list[int] = [role_ids] # type: ignore
-        for role_id in role_ids:
-            await self._add_role(member_id, role_id, reason=reason)
-            await asyncio.sleep(1)
+        return await asyncio.gather(*(self._add_role(member_id, role_id, reason=reason) for role_id in role_ids))
 
     async def _del_role(self, member_id: str | int, role_id: str | int, reason: str = "Subscription with Stripe has been deactivated. (dinosaur-stripeconnect)"):
-        headers = {
-            "Authorization": self._authorization,
-            "Content-Type": self._content_type,
-            "X-Audit-Log-Reason": reason
-        }
-        async with aiohttp.ClientSession() as sess:
-            async with sess.delete(f"{self._api_url}/guilds/{self.guild_id}/members/{member_id}/roles/{role_id}", headers=headers) as resp:
-                logging.info("Del Role (Discord API)", resp.status)
-                if resp.status == 204:
-                    return True
-                else:
-                    return False
+        status, _ = await self._request("DELETE", "/guilds/{guild_id}/members/{member_id}/roles/{role_id}", reason=reason, member_id=member_id, role_id=role_id)
+        logging.info("Del Role (Discord API) %s", status)
+        return status == 204
 
     async def del_roles(self, member_id: str | int, role_ids: str | int | list[str] | list[int], reason: str = "Subscription with Stripe has been deactivated. (dinosaur-stripeconnect)"):
         if isinstance(role_ids, str) or isinstance(role_ids, int):
             role_ids: list[str] | list[int] = [role_ids] # type: ignore
-        for role_id in role_ids:
-            await self._del_role(member_id, role_id, reason=reason)
-            await asyncio.sleep(1)
+        return await asyncio.gather(*(self._del_role(member_id, role_id, reason=reason) for role_id in role_ids))
 
     async def fetch_member(self, user_id: str | int) -> dict | None:
-        """Fetch a Guid Member Object from the Discord API"""
-        async with aiohttp.ClientSession() as sess:
-            async with sess.get(f"{self._api_url}/guilds/{self.guild_id}/members/{user_id}", headers={"Authorization": self._authorization}) as resp:
-                logging.info("Get Guild Member (Discord API)", resp.status)
-                if resp.status == 200:
-                    return await resp.json()
-                else:
-                    return None
+        """Fetch a Guid Member Object from the Discord API (or the member cache)"""
+        return await self.members.get_or_fetch(str(user_id), lambda: self._fetch_member(user_id))
+
+    async def _fetch_member(self, user_id: str | int) -> dict | None:
+        with metricsmodel.STAGE_SECONDS.time("fetch_member"):
+            status, data = await self._request("GET", "/guilds/{guild_id}/members/{user_id}", user_id=user_id)
+        logging.info("Get Guild Member (Discord API) %s", status)
+        if status == 200:
+            return data
+        else:
+            return None
+
+    async def iter_members(self, limit: int = 1000) -> AsyncIterator[list[dict]]:
+        """Page through the Guild Members (requires the GUILD_MEMBERS intent)"""
+        after = "0"
+        while True:
+            status, data = await self._request("GET", "/guilds/{guild_id}/members", query={"limit": limit, "after": after})
+            if status != 200:
+                raise RuntimeError(f"List Guild Members (Discord API) failed: {status}")
+            if not data:
+                return
+            yield data
+            if len(data) < limit:
+                return
+            after = data[-1]["user"]["id"]
+
+    async def warm_members(self, user_ids: set[str]) -> int:
+        """Fill the member cache with the given users by paging through the guild"""
+        user_ids = set(user_ids)
+        cached = 0
+        async for members in self.iter_members():
+            for member in members:
+                if member["user"]["id"] in user_ids:
+                    self.members.set(member["user"]["id"], member)
+                    user_ids.discard(member["user"]["id"])
+                    cached += 1
+            if not user_ids or cached >= self.members.max_size:
+                break
+        logging.info("Member cache warmed up (%d members)", cached)
+        return cached
+
+    async def modify_roles(
+            self,
+            member: dict,
+            add: list[str] | list[int] | set[str] | None = None,
+            remove: list[str] | list[int] | set[str] | None = None,
+            reason: str = MODIFY_ROLES_REASON
+        ) -> bool | None:
+        """Apply a role delta to a Guild Member Object with a single Modify Guild Member request
+
+        The request replaces the whole role list, so the delta is applied to the member's
+        current roles fetched right before, never to the (possibly stale) cached ones.
+        Roles in `add` win over roles in `remove`. Returns None if the member already has
+        the target roles (no request is sent), otherwise whether the request succeeded."""
+        if not add and not remove:
+            return None
+        try:
+            fresh = await self._fetch_member(member["user"]["id"])
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logging.warning("Get Guild Member (Discord API) failed: %r", e)
+            fresh = None
+        if fresh is None:
+            return False
+        member["roles"] = fresh.get("roles", [])
+        current = set(member["roles"])
+        target = (current - {str(r) for r in remove or ()}) | {str(r) for r in add or ()}
+        if target == current:
+            return None
+        try:
+            with metricsmodel.STAGE_SECONDS.time("modify_roles"):
+                status, data = await self._request("PATCH", "/guilds/{guild_id}/members/{user_id}", reason=reason, json={"roles": sorted(target)}, user_id=member["user"]["id"])
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logging.warning("Modify Guild Member (Discord API) failed: %r", e)
+            status, data = 0, None
+        logging.info("Modify Guild Member (Discord API) %s", status)
+        if status in (200, 204):
+            if isinstance(data, dict) and "roles" in data:
+                member.update(data) # The updated Guild Member Object
+            else:
+                member["roles"] = sorted(target)
+            self.members.set(str(member["user"]["id"]), member) # Fresh, e.g. for the next event of a checkout
+            return True
+        self.members.invalidate(str(member["user"]["id"]))
+        return False
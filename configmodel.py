@@ -1,5 +1,78 @@
+import json
+import types
+from typing import Mapping
+
+# Keys that take effect when the config is reloaded. The others are read once at startup
+RELOADABLE = frozenset((
+    "DISCORD_GUILD_ID",
+    "ROLES",
+    "GUILDS",
+    "PRODUCTS_BY_ROLE",
+    "MANAGED_ROLES",
+    "ASYNC_WEBHOOK",
+    "ADMIN_TOKEN",
+    "METRICS",
+    "STRIPE_WEBHOOK_SECRET",
+    "STRIPE_WEBHOOK_SECRETS",
+    "STRIPE_WEBHOOK_TOLERANCE",
+    "CONFIG_RELOAD_INTERVAL",
+))
+
 class Config:
-    def __init__(self, DISCORD_TOKEN, STRIPE_API_KEY, DISCORD_GUILD_ID, SERVER_PORT, ROLES, NOTIFY_WEBHOOK):
+    """Immutable, validated snapshot of `config.json`
+
+    A reload builds a new snapshot and swaps it in, so code holding a reference keeps a
+    consistent view of every key."""
+    def __init__(
+            self,
+            DISCORD_TOKEN,
+            STRIPE_API_KEY,
+            DISCORD_GUILD_ID,
+            SERVER_PORT,
+            ROLES,
+            NOTIFY_WEBHOOK,
+            ASYNC_WEBHOOK=False,
+            WORKER_CONCURRENCY=4,
+            WORKER_QUEUE_SIZE=1000,
+            ORDERING_WINDOW=0.0,
+            DATABASE_PATH="./dinosaur-stripeconnect.db",
+            EVENT_HISTORY="sqlite",
+            EVENT_HISTORY_TTL=2592000,
+            EVENT_HISTORY_SIZE=100000,
+            USERDATA_COMPACT_INTERVAL=3600,
+            HTTP_CONNECTION_LIMIT=100,
+            HTTP_DNS_CACHE_TTL=300,
+            MEMBER_CACHE_TTL=60,
+            MEMBER_CACHE_SIZE=10000,
+            MEMBER_CACHE_WARMUP=False,
+            SUBSCRIPTION_CACHE_TTL=300,
+            SUBSCRIPTION_CACHE_SIZE=10000,
+            NOTIFY_BATCH_WINDOW=2.0,
+            RETRY_MAX_ATTEMPTS=8,
+            RETRY_BASE_DELAY=5,
+            RETRY_MAX_DELAY=3600,
+            RETRY_DRAIN_RATE=5,
+            ADMIN_TOKEN=None,
+            RECONCILE_INTERVAL=0,
+            EVENT_CATCHUP=True,
+            METRICS=True,
+            DISCORD_API_BASE="https://discord.com/api",
+            STRIPE_API_BASE="https://api.stripe.com",
+            LOG_FILE="./dinosaur-stripeconnect.log",
+            LOG_MAX_BYTES=10485760,
+            LOG_BACKUP_COUNT=5,
+            LOG_ROTATE_WHEN=None,
+            LOG_JSON=False,
+            SERVER_WORKERS=1,
+            STRIPE_WEBHOOK_SECRET=None,
+            STRIPE_WEBHOOK_TOLERANCE=300,
+            EVENT_ARCHIVE="./event-archive",
+            EVENT_ARCHIVE_MAX_BYTES=67108864,
+            EVENT_ARCHIVE_BACKUP_COUNT=20,
+            CONFIG_RELOAD_INTERVAL=5,
+            GUILDS=None,
+            DISCORD_GUILD_CONCURRENCY=4,
+        ):
         self.DISCORD_TOKEN: str = DISCORD_TOKEN
         if STRIPE_API_KEY[:3] != "sk_":
             raise ValueError("Invalid Stripe API Key (Stripe API Key must start with 'sk_')")
@@ -7,8 +80,102 @@ class Config:
         if STRIPE_API_KEY[:8] == "sk_live_":
             self.LIVE: bool = True
         self.STRIPE_API_KEY: str = STRIPE_API_KEY
-        self.DISCORD_GUILD_ID: str | int = DISCORD_GUILD_ID
+        if not str(DISCORD_GUILD_ID).isdigit():
+            raise ValueError("Invalid DISCORD_GUILD_ID (must be a Discord guild ID)")
+        self.DISCORD_GUILD_ID: str = str(DISCORD_GUILD_ID)
         self.SERVER_PORT: int = SERVER_PORT
-        self.ROLES: dict[str, str] = ROLES
+        self.ROLES: Mapping[str, str] = _roles(ROLES, "ROLES") # Product -> Role in DISCORD_GUILD_ID
+        if GUILDS is not None and not isinstance(GUILDS, dict):
+            raise ValueError("Invalid GUILDS (must map Discord guild IDs to ROLES)")
+        guilds = {self.DISCORD_GUILD_ID: self.ROLES}
+        for guild_id, roles in (GUILDS or {}).items():
+            if not str(guild_id).isdigit() or str(guild_id) in guilds:
+                raise ValueError(f"Invalid GUILDS (guild ID {guild_id} is not a Discord guild ID or is given twice)")
+            guilds[str(guild_id)] = _roles(roles, f"GUILDS[{guild_id}]")
+        self.GUILDS: Mapping[str, Mapping[str, str]] = types.MappingProxyType(guilds) # Guild -> Product -> Role, DISCORD_GUILD_ID first
+        products_by_role: dict[str, set[str]] = {}
+        for roles in guilds.values():
+            for product, role_id in roles.items():
+                products_by_role.setdefault(role_id, set()).add(product)
+        self.PRODUCTS_BY_ROLE: Mapping[str, frozenset[str]] = types.MappingProxyType({role_id: frozenset(products) for role_id, products in products_by_role.items()}) # Role -> Products
+        self.MANAGED_ROLES: frozenset[str] = frozenset(products_by_role) # Roles this bot adds and removes, in every guild
         self.NOTIFY_WEBHOOK: str = NOTIFY_WEBHOOK
+        self.ASYNC_WEBHOOK: bool = ASYNC_WEBHOOK
+        if WORKER_CONCURRENCY < 1 or WORKER_QUEUE_SIZE < 1:
+            raise ValueError("Invalid worker settings (WORKER_CONCURRENCY and WORKER_QUEUE_SIZE must be 1 or more)")
+        self.WORKER_CONCURRENCY: int = WORKER_CONCURRENCY
+        self.WORKER_QUEUE_SIZE: int = WORKER_QUEUE_SIZE
+        self.ORDERING_WINDOW: float = ORDERING_WINDOW
+        self.DATABASE_PATH: str = DATABASE_PATH
+        if EVENT_HISTORY not in ("sqlite", "memory"):
+            raise ValueError("Invalid event history backend (EVENT_HISTORY must be 'sqlite' or 'memory')")
+        self.EVENT_HISTORY: str = EVENT_HISTORY
+        self.EVENT_HISTORY_TTL: int = EVENT_HISTORY_TTL
+        self.EVENT_HISTORY_SIZE: int = EVENT_HISTORY_SIZE
+        self.USERDATA_COMPACT_INTERVAL: int = USERDATA_COMPACT_INTERVAL
+        self.HTTP_CONNECTION_LIMIT: int = HTTP_CONNECTION_LIMIT
+        self.HTTP_DNS_CACHE_TTL: int = HTTP_DNS_CACHE_TTL
+        self.MEMBER_CACHE_TTL: int = MEMBER_CACHE_TTL
+        self.MEMBER_CACHE_SIZE: int = MEMBER_CACHE_SIZE
+        self.MEMBER_CACHE_WARMUP: bool = MEMBER_CACHE_WARMUP
+        self.SUBSCRIPTION_CACHE_TTL: int = SUBSCRIPTION_CACHE_TTL
+        self.SUBSCRIPTION_CACHE_SIZE: int = SUBSCRIPTION_CACHE_SIZE
+        self.NOTIFY_BATCH_WINDOW: float = NOTIFY_BATCH_WINDOW
+        if RETRY_MAX_ATTEMPTS < 1 or RETRY_DRAIN_RATE <= 0:
+            raise ValueError("Invalid retry settings (RETRY_MAX_ATTEMPTS must be 1 or more and RETRY_DRAIN_RATE must be positive)")
+        self.RETRY_MAX_ATTEMPTS: int = RETRY_MAX_ATTEMPTS
+        self.RETRY_BASE_DELAY: float = RETRY_BASE_DELAY
+        self.RETRY_MAX_DELAY: float = RETRY_MAX_DELAY
+        self.RETRY_DRAIN_RATE: float = RETRY_DRAIN_RATE
+        self.ADMIN_TOKEN: str | None = ADMIN_TOKEN
+        self.RECONCILE_INTERVAL: int = RECONCILE_INTERVAL
+        self.EVENT_CATCHUP: bool = EVENT_CATCHUP
+        self.METRICS: bool = METRICS
+        self.DISCORD_API_BASE: str = DISCORD_API_BASE
+        self.STRIPE_API_BASE: str = STRIPE_API_BASE
+        self.LOG_FILE: str = LOG_FILE
+        self.LOG_MAX_BYTES: int = LOG_MAX_BYTES
+        self.LOG_BACKUP_COUNT: int = LOG_BACKUP_COUNT
+        self.LOG_ROTATE_WHEN: str | None = LOG_ROTATE_WHEN
+        self.LOG_JSON: bool = LOG_JSON
+        if SERVER_WORKERS < 1:
+            raise ValueError("Invalid SERVER_WORKERS (must be 1 or more)")
+        if SERVER_WORKERS > 1 and EVENT_HISTORY != "sqlite":
+            raise ValueError("EVENT_HISTORY must be 'sqlite' with more than one SERVER_WORKERS")
+        self.SERVER_WORKERS: int = SERVER_WORKERS
+        self.STRIPE_WEBHOOK_SECRET: str | list[str] | None = STRIPE_WEBHOOK_SECRET
+        secrets = [STRIPE_WEBHOOK_SECRET] if isinstance(STRIPE_WEBHOOK_SECRET, str) else list(STRIPE_WEBHOOK_SECRET or [])
+        if any(secret[:6] != "whsec_" for secret in secrets):
+            raise ValueError("Invalid Stripe webhook signing secret (it must start with 'whsec_')")
+        self.STRIPE_WEBHOOK_SECRETS: tuple[bytes, ...] = tuple(secret.encode() for secret in secrets) # Stripe-Signature is not checked if empty
+        self.STRIPE_WEBHOOK_TOLERANCE: int = STRIPE_WEBHOOK_TOLERANCE
+        if EVENT_ARCHIVE and (EVENT_ARCHIVE_MAX_BYTES < 1 or EVENT_ARCHIVE_BACKUP_COUNT < 1):
+            raise ValueError("Invalid event archive settings (EVENT_ARCHIVE_MAX_BYTES and EVENT_ARCHIVE_BACKUP_COUNT must be 1 or more)")
+        self.EVENT_ARCHIVE: str | None = EVENT_ARCHIVE
+        self.EVENT_ARCHIVE_MAX_BYTES: int = EVENT_ARCHIVE_MAX_BYTES
+        self.EVENT_ARCHIVE_BACKUP_COUNT: int = EVENT_ARCHIVE_BACKUP_COUNT
+        self.CONFIG_RELOAD_INTERVAL: float = CONFIG_RELOAD_INTERVAL
+        if DISCORD_GUILD_CONCURRENCY < 1:
+            raise ValueError("Invalid DISCORD_GUILD_CONCURRENCY (must be 1 or more)")
+        self.DISCORD_GUILD_CONCURRENCY: int = DISCORD_GUILD_CONCURRENCY
+        self._frozen = True
+
+    def __setattr__(self, name: str, value) -> None:
+        if getattr(self, "_frozen", False):
+            raise AttributeError(f"Config is immutable (load a new snapshot to change {name})")
+        super().__setattr__(name, value)
+
+    def changed(self, other: "Config") -> list[str]:
+        """Keys whose values differ from another snapshot"""
+        return [key for key, value in vars(self).items() if not key.startswith("_") and vars(other).get(key) != value]
+
+def _roles(roles, key: str) -> Mapping[str, str]:
+    """Read-only Product -> Role map with str IDs"""
+    if not isinstance(roles, dict) or any(not str(role_id).isdigit() for role_id in roles.values()):
+        raise ValueError(f"Invalid {key} (must map Stripe product IDs to Discord role IDs)")
+    return types.MappingProxyType({str(product): str(role_id) for product, role_id in roles.items()})
 
+def load(path: str = "config.json") -> Config:
+    """Read and validate a config file. Raises on invalid config"""
+    with open(path, "r") as f:
+        return Config(**json.load(f))
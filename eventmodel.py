@@ -0,0 +1,155 @@
+import enum
+import hashlib
+import hmac
+import json
+import time
+from typing import Iterable, Mapping, Sequence
+
+import notification
+
+class ActionType(enum.Enum):
+    ADD = 1
+    REMOVE = 2
+    ADDITIONAL_REMOVE = 3
+    SKIP = 4
+
+CHECKOUT_COMPLETED = "checkout.session.completed"
+SUBSCRIPTION_UPDATED = "customer.subscription.updated"
+SUBSCRIPTION_DELETED = "customer.subscription.deleted"
+
+SUPPORTED_EVENTS = frozenset((CHECKOUT_COMPLETED, SUBSCRIPTION_UPDATED, SUBSCRIPTION_DELETED))
+
+# Subscription status -> (action, title, color, status, role state, show target role)
+STATUSES = {
+    "trialing": (ActionType.ADD, "トライアルが開始されました！", 0x00ff00, "トライアル中", "付与されました。（期限が切れるとロールは削除されます。）", True),
+    "active": (ActionType.ADD, "サブスクリプションが開始されました！", 0x00ff00, "サブスクリプションアクティブ", "付与されました。（期限が切れるとロールは削除されます。）", True),
+    "incomplete": (ActionType.SKIP, "支払いを待機しています。", 0xffff00, "購入を試みたが支払いは完了していない", "操作は行われません。", False),
+    "incomplete_expired": (ActionType.REMOVE, "支払いに失敗しました", 0xff0000, "購入を試みたが支払いに失敗", "削除されました。", True),
+    "past_due": (ActionType.REMOVE, "自動決済に失敗しました", 0xff0000, "自動決済に失敗（Stripeのリトライルールに基づき再度支払いを試みる場合があります）", "削除されました。", True),
+    "canceled": (ActionType.REMOVE, "支払いがキャンセルされました。", 0xff0000, "支払いキャンセル", "削除されました。", True),
+    "unpaid": (ActionType.REMOVE, "支払いは行われませんでした。", 0xff0000, "支払いは行われませんでした。", "削除されました。", True),
+}
+
+# (event type, subscription status) -> (action, notification embed)
+DISPATCH: dict[tuple[str, str | None], tuple[ActionType, notification.EmbedTemplate]] = {
+    (event_type, status): (action, notification.EmbedTemplate(title, color, f"{label}\n`{event_type}`/`{status}`", role_state, role_field))
+    for event_type in (CHECKOUT_COMPLETED, SUBSCRIPTION_UPDATED)
+    for status, (action, title, color, label, role_state, role_field) in STATUSES.items()
+}
+DISPATCH[(SUBSCRIPTION_DELETED, None)] = (
+    ActionType.REMOVE,
+    notification.EmbedTemplate("サブスクリプションが削除されました。", 0xff0000, f"サブスクリプションが削除されました。\n`{SUBSCRIPTION_DELETED}`", "削除されました。"),
+)
+
+class StripeEvent:
+    """The parts of a Stripe Event Object used here, decoded once from the webhook body"""
+    __slots__ = ("id", "type", "created", "object", "previous_attributes")
+
+    def __init__(self, id: str, type: str, created: int, object: dict, previous_attributes: dict | None = None) -> None:
+        self.id = id # evt_...
+        self.type = type # e.g. customer.subscription.updated
+        self.created = created # Unix time
+        self.object = object # data.object
+        self.previous_attributes = previous_attributes or {} # data.previous_attributes
+
+    @property
+    def customer(self) -> str | None:
+        return self.object.get("customer")
+
+    @classmethod
+    def from_dict(cls, event: dict) -> "StripeEvent":
+        data = event["data"]
+        previous_attributes = data.get("previous_attributes")
+        if (
+            not isinstance(event["id"], str)
+            or not isinstance(event["type"], str)
+            or not isinstance(event["created"], int) or isinstance(event["created"], bool)
+            or not isinstance(data["object"], dict)
+            or not isinstance(previous_attributes, (dict, type(None)))
+        ):
+            raise ValueError("Invalid event: unexpected field types")
+        return cls(event["id"], event["type"], event["created"], data["object"], previous_attributes)
+
+    @classmethod
+    def from_json(cls, body: bytes) -> "StripeEvent":
+        """Raises ValueError if the body is not a Stripe Event Object"""
+        try:
+            event = json.loads(body)
+            return cls.from_dict(event)
+        except (KeyError, TypeError, AttributeError) as e:
+            raise ValueError(f"Invalid event: {e!r}") from e
+
+    def to_dict(self) -> dict:
+        data = {"object": self.object}
+        if self.previous_attributes:
+            data["previous_attributes"] = self.previous_attributes
+        return {"id": self.id, "object": "event", "type": self.type, "created": self.created, "data": data}
+
+MAX_SIGNATURE_HEADER = 1024 # Longer Stripe-Signature headers are rejected unread
+MAX_SIGNATURES = 8 # v1 signatures checked per request
+
+def verify_signature(payload: bytes, header: str | None, secrets: Sequence[bytes], tolerance: float = 300, now: float | None = None) -> bool:
+    """Check the `Stripe-Signature` header of a webhook against the raw body
+
+    Cheap checks (header shape, timestamp tolerance) run before any HMAC, and every
+    secret is tried so that signing secrets can be rotated."""
+    if not header or len(header) > MAX_SIGNATURE_HEADER or not secrets:
+        return False
+    timestamp, signatures = None, []
+    for part in header.split(","):
+        key, _, value = part.strip().partition("=")
+        if key == "t":
+            timestamp = value
+        elif key == "v1" and len(signatures) < MAX_SIGNATURES:
+            signatures.append(value.encode())
+    if timestamp is None or not (timestamp.isascii() and timestamp.isdigit()) or not signatures: # isdigit() alone accepts e.g. "²"
+        return False
+    if abs((time.time() if now is None else now) - int(timestamp)) > tolerance:
+        return False
+    signed_payload = timestamp.encode() + b"." + payload
+    for secret in secrets:
+        expected = hmac.new(secret, signed_payload, hashlib.sha256).hexdigest().encode()
+        # Compare against every signature, so the time taken does not depend on which one matches
+        if sum(hmac.compare_digest(expected, signature) for signature in signatures):
+            return True
+    return False
+
+def sign_payload(payload: bytes, secret: bytes, timestamp: int | None = None) -> str:
+    """A `Stripe-Signature` header for the payload (for tests and the load test)"""
+    timestamp = int(time.time()) if timestamp is None else timestamp
+    signature = hmac.new(secret, str(timestamp).encode() + b"." + payload, hashlib.sha256).hexdigest()
+    return f"t={timestamp},v1={signature}"
+
+def plan_event(
+        event_type: str,
+        status: str | None,
+        items: Iterable[dict],
+        previous_items: Iterable[dict],
+        roles: Mapping[str, str],
+        member_name: str,
+        member_id: str,
+        event_id: str
+    ) -> tuple[list[dict], list[notification.DiscordEmbed]] | None:
+    """Turn the subscription items of an event into role actions and notifications
+
+    Items whose product is not in `roles` are ignored. Returns None if the status is not
+    supported for the event type."""
+    actions: list[dict] = []
+    embeds: list[notification.DiscordEmbed] = []
+    for item in previous_items:
+        role_id = roles.get(item["plan"]["product"])
+        if role_id is not None:
+            actions.append({"action": ActionType.ADDITIONAL_REMOVE, "role_id": role_id})
+    entry = None
+    for item in items:
+        product = item["plan"]["product"] # prod_...
+        role_id = roles.get(product) # Discord Snowflake RoleID
+        if role_id is None:
+            continue
+        if entry is None:
+            entry = DISPATCH.get((event_type, status))
+            if entry is None:
+                return None
+        actions.append({"action": entry[0], "role_id": role_id})
+        embeds.append(entry[1].render(member_name, member_id, product, role_id, event_id))
+    return actions, embeds
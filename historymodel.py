@@ -0,0 +1,160 @@
+import abc
+import collections
+import logging
+import sqlite3
+import time
+
+class EventHistory(abc.ABC):
+    """Idempotency store for processed Stripe event IDs"""
+    @abc.abstractmethod
+    def add(self, event_id: str) -> bool:
+        """Record an event. Returns False if it was already recorded"""
+
+    @abc.abstractmethod
+    def discard(self, event_id: str) -> None:
+        """Forget an event so that a resend is processed again"""
+
+    def complete(self, event_id: str) -> None:
+        """Mark a recorded event as processed"""
+        pass
+
+    @abc.abstractmethod
+    def __contains__(self, event_id: str) -> bool:
+        """Whether an event is recorded and not expired"""
+
+    def close(self) -> None:
+        pass
+
+class MemoryEventHistory(EventHistory):
+    """In-memory event history with TTL and LRU eviction"""
+    def __init__(self, ttl: float = 2592000, max_size: int = 100000) -> None:
+        self.ttl = ttl # Seconds to remember an event
+        self.max_size = max_size # Max number of remembered events
+        self._events: collections.OrderedDict[str, float] = collections.OrderedDict() # event_id -> expires_at
+
+    def __len__(self) -> int:
+        return len(self._events)
+
+    def __contains__(self, event_id: str) -> bool:
+        expires_at = self._events.get(event_id)
+        if expires_at is None:
+            return False
+        if expires_at < time.monotonic():
+            del self._events[event_id]
+            return False
+        return True
+
+    def add(self, event_id: str) -> bool:
+        if event_id in self:
+            self._events.move_to_end(event_id)
+            return False
+        self._events[event_id] = time.monotonic() + self.ttl
+        while len(self._events) > self.max_size:
+            self._events.popitem(last=False)
+        return True
+
+    def discard(self, event_id: str) -> None:
+        self._events.pop(event_id, None)
+
+class SQLiteEventHistory(EventHistory):
+    """SQLite-backed event history that survives restarts
+
+    Recently seen events are kept in a small in-memory LRU in front of the database,
+    and expired rows are pruned every `prune_interval` additions. An event that was
+    recorded but not completed within `processing_timeout` (e.g. its process crashed)
+    is accepted again, so Stripe's resend is processed."""
+    def __init__(self, path: str, ttl: float = 2592000, cache_size: int = 10000, prune_interval: int = 1000, processing_timeout: float = 300) -> None:
+        self.path = path
+        self.ttl = ttl
+        self.prune_interval = prune_interval
+        self.processing_timeout = processing_timeout
+        self._cache = MemoryEventHistory(ttl, cache_size)
+        self._added = 0
+        self._db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS event_history (event_id TEXT PRIMARY KEY, created REAL NOT NULL) WITHOUT ROWID")
+        self._db.execute("CREATE INDEX IF NOT EXISTS event_history_created ON event_history (created)")
+        if "done" not in {row[1] for row in self._db.execute("PRAGMA table_info(event_history)")}:
+            self._db.execute("ALTER TABLE event_history ADD COLUMN done INTEGER NOT NULL DEFAULT 1")
+        self.prune()
+
+    def __contains__(self, event_id: str) -> bool:
+        if event_id in self._cache:
+            return True
+        row = self._db.execute("SELECT 1 FROM event_history WHERE event_id = ? AND created >= ?", (event_id, time.time() - self.ttl)).fetchone()
+        return row is not None
+
+    def add(self, event_id: str) -> bool:
+        if event_id in self._cache:
+            return False
+        now = time.time()
+        # Insert, or take over a row that has expired but was not pruned yet, or whose processing was abandoned
+        cursor = self._db.execute(
+            "INSERT INTO event_history (event_id, created, done) VALUES (?, ?, 0) "
+            "ON CONFLICT (event_id) DO UPDATE SET created = excluded.created, done = 0 WHERE created < ? OR (done = 0 AND created < ?)",
+            (event_id, now, now - self.ttl, now - self.processing_timeout),
+        )
+        added = cursor.rowcount > 0
+        # Not an event another worker is still processing: it may yet discard it or abandon it
+        if added or self._db.execute("SELECT done FROM event_history WHERE event_id = ?", (event_id,)).fetchone() == (1,):
+            self._cache.add(event_id)
+        self._added += 1
+        if self._added % self.prune_interval == 0:
+            self.prune()
+        return added
+
+    def discard(self, event_id: str) -> None:
+        self._cache.discard(event_id)
+        self._db.execute("DELETE FROM event_history WHERE event_id = ?", (event_id,))
+
+    def complete(self, event_id: str) -> None:
+        self._db.execute("UPDATE event_history SET done = 1 WHERE event_id = ?", (event_id,))
+
+    def prune(self) -> int:
+        """Delete expired events from the database"""
+        cursor = self._db.execute("DELETE FROM event_history WHERE created < ?", (time.time() - self.ttl,))
+        if cursor.rowcount:
+            logging.info("Pruned %d expired events from the event history", cursor.rowcount)
+        return cursor.rowcount
+
+    def close(self) -> None:
+        self._db.close()
+
+class EventCursor:
+    """The newest Stripe event accepted by the webhook, persisted for the startup catch-up"""
+    def __init__(self, path: str, name: str = "webhook") -> None:
+        self.path = path
+        self.name = name
+        self._db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS event_cursor (name TEXT PRIMARY KEY, event_id TEXT NOT NULL, created INTEGER NOT NULL) WITHOUT ROWID")
+
+    def get(self) -> tuple[str, int] | None:
+        """(event_id, created) of the newest event, or None before the first event"""
+        row = self._db.execute("SELECT event_id, created FROM event_cursor WHERE name = ?", (self.name,)).fetchone()
+        return (row[0], row[1]) if row else None
+
+    def advance(self, event_id: str, created: int) -> None:
+        """Move the cursor to the event unless a newer event was already recorded"""
+        self._db.execute(
+            "INSERT INTO event_cursor (name, event_id, created) VALUES (?, ?, ?) "
+            "ON CONFLICT (name) DO UPDATE SET event_id = excluded.event_id, created = excluded.created WHERE created <= excluded.created",
+            (self.name, event_id, created),
+        )
+
+    def mark(self, event_id: str, created: int) -> None:
+        """Record the event unless an event is already recorded (which is kept)"""
+        self._db.execute("INSERT OR IGNORE INTO event_cursor (name, event_id, created) VALUES (?, ?, ?)", (self.name, event_id, created))
+
+    def clear(self) -> None:
+        self._db.execute("DELETE FROM event_cursor WHERE name = ?", (self.name,))
+
+def open_history(kind: str, path: str, ttl: float, max_size: int) -> EventHistory:
+    """Create the event history configured with EVENT_HISTORY"""
+    if kind == "memory":
+        return MemoryEventHistory(ttl, max_size)
+    elif kind == "sqlite":
+        return SQLiteEventHistory(path, ttl, max_size)
+    raise ValueError(f"Unknown event history backend: {kind}")
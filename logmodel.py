@@ -0,0 +1,130 @@
+import atexit
+import contextvars
+import datetime
+import json
+import logging
+import logging.handlers
+import queue
+import threading
+
+FORMAT = "%(asctime)s$%(filename)s$%(lineno)d$%(funcName)s$%(levelname)s:%(message)s"
+
+# Set while an event is processed, and attached to every record logged meanwhile
+event_id_var: contextvars.ContextVar[str | None] = contextvars.ContextVar("event_id", default=None)
+customer_var: contextvars.ContextVar[str | None] = contextvars.ContextVar("customer", default=None)
+
+class ContextFilter(logging.Filter):
+    """Copy the event context onto the record, in the thread (and task) that logs it"""
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.event_id = event_id_var.get()
+        record.customer = customer_var.get()
+        return True
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per line"""
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "file": record.filename,
+            "line": record.lineno,
+            "func": record.funcName,
+            "message": record.getMessage(),
+        }
+        for key in ("event_id", "customer"):
+            value = getattr(record, key, None)
+            if value is not None:
+                entry[key] = value
+        return json.dumps(entry, ensure_ascii=False)
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Hands records to the writer thread without ever blocking the caller
+
+    Records are dropped (and counted) while the queue is full."""
+    def __init__(self, queue: queue.Queue) -> None:
+        super().__init__(queue)
+        self.dropped: int = 0
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+class BatchWriter(threading.Thread):
+    """Writes queued records with one flush per batch"""
+    def __init__(self, queue: queue.Queue, handler: logging.Handler, batch_size: int = 500) -> None:
+        super().__init__(name="log-writer", daemon=True)
+        self.queue = queue
+        self.handler = handler
+        self.batch_size = batch_size # Max records per flush
+
+    def run(self) -> None:
+        while True:
+            records = [self.queue.get()]
+            while len(records) < self.batch_size:
+                try:
+                    records.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = None in records
+            with self.handler.lock: # type: ignore
+                self.handler.batching = True # type: ignore
+                try:
+                    for record in records:
+                        if record is not None:
+                            self.handler.handle(record)
+                finally:
+                    self.handler.batching = False # type: ignore
+                    self.handler.flush()
+            if stop:
+                return
+
+    def stop(self, timeout: float = 5) -> None:
+        """Write the queued records and stop"""
+        self.queue.put(None)
+        self.join(timeout)
+
+class _BatchFlush:
+    """Skip the flush after every record while a batch is written"""
+    batching = False
+
+    def flush(self) -> None:
+        if not self.batching:
+            super().flush() # type: ignore
+
+class BatchRotatingFileHandler(_BatchFlush, logging.handlers.RotatingFileHandler):
+    pass
+
+class BatchTimedRotatingFileHandler(_BatchFlush, logging.handlers.TimedRotatingFileHandler):
+    pass
+
+def setup(
+        filename: str,
+        max_bytes: int = 10485760,
+        backup_count: int = 5,
+        rotate_when: str | None = None,
+        json_lines: bool = False,
+        level: str = "INFO",
+        queue_size: int = 10000
+    ) -> DroppingQueueHandler:
+    """Route the root logger through a queue to a background writer thread
+
+    Files rotate at `max_bytes`, or at `rotate_when` (e.g. `midnight`, see
+    TimedRotatingFileHandler) if set."""
+    if rotate_when:
+        handler: logging.Handler = BatchTimedRotatingFileHandler(filename, when=rotate_when, backupCount=backup_count, encoding="utf-8")
+    else:
+        handler = BatchRotatingFileHandler(filename, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8")
+    handler.setFormatter(JSONFormatter() if json_lines else logging.Formatter(FORMAT))
+    records: queue.Queue = queue.Queue(queue_size)
+    queue_handler = DroppingQueueHandler(records)
+    queue_handler.addFilter(ContextFilter())
+    writer = BatchWriter(records, handler)
+    writer.start()
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(queue_handler)
+    atexit.register(writer.stop)
+    return queue_handler
@@ -1,368 +1,503 @@
+import aiohttp
+import argparse
 import asyncio
-import aiofiles
+import datetime
+import hmac
 import logging
+import multiprocessing
 import sanic
-import json
-import enum
+import os
+import signal
+import time
 
 import sys
 
 from async_stripe import stripe
 from sanic import response
+from typing import Mapping
 
+from eventmodel import ActionType
+
+import archivemodel
+import cachemodel
 import clientmodel
 import configmodel
+import eventmodel
+import historymodel
+import logmodel
+import metricsmodel
 import notification
+import reconcilemodel
+import retrymodel
+import userdatamodel
+import workermodel
 
-logging.basicConfig(
-    format="%(asctime)s$%(filename)s$%(lineno)d$%(funcName)s$%(levelname)s:%(message)s",
-    filename="./dinosaur-stripeconnect.log",
-    level="INFO",
-)
+CONFIG_PATH = "config.json"
+CONFIG = configmodel.load(CONFIG_PATH) # Swapped for a new snapshot by reload_config()
 
-CONFIG = configmodel.Config(**json.load(open("config.json", "r")))
+def log_file() -> str:
+    """LOG_FILE, with the worker name (e.g. `Sanic-Server-0-0`) in Sanic worker processes
 
-stripe.api_key = CONFIG.STRIPE_API_KEY
+    Every process rotates its own file, so they must not share one."""
+    worker = os.environ.get("SANIC_WORKER_NAME")
+    if not worker:
+        return CONFIG.LOG_FILE # The Sanic manager process, or a command
+    root, ext = os.path.splitext(CONFIG.LOG_FILE)
+    return f"{root}.{worker}{ext}"
 
-userdata: dict[str, str] = {}
+log_handler = logmodel.setup(log_file(), CONFIG.LOG_MAX_BYTES, CONFIG.LOG_BACKUP_COUNT, CONFIG.LOG_ROTATE_WHEN, CONFIG.LOG_JSON)
+
+stripe.api_key = CONFIG.STRIPE_API_KEY
+stripe.api_base = CONFIG.STRIPE_API_BASE
 
-async def write_userdata(data) -> None:
-    async with aiofiles.open("userdata", "w") as f:
-        await f.write(json.dumps(data))
+userdata = userdatamodel.UserData(CONFIG.DATABASE_PATH) # Stripe Customer -> Discord User
 
 def read_userdata():
-    global userdata
-    try:
-        with open("userdata", "r") as f:
-            userdata = json.loads(f.read())
-    except FileNotFoundError:
-        with open("userdata", "w") as f:
-            f.write("{}")
-        userdata = {}
+    """Import the legacy JSON `userdata` file into the database (first run after upgrading)"""
+    userdata.import_json("userdata")
 
-event_history = []
+async def compact_userdata():
+    while True:
+        await asyncio.sleep(CONFIG.USERDATA_COMPACT_INTERVAL)
+        userdata.compact()
 
-class ActionType(enum.Enum):
-    ADD = 1
-    REMOVE = 2
-    ADDITIONAL_REMOVE = 3
-    SKIP = 4
+retry_queue = retrymodel.RetryQueue(CONFIG.DATABASE_PATH, CONFIG.RETRY_MAX_ATTEMPTS, CONFIG.RETRY_BASE_DELAY, CONFIG.RETRY_MAX_DELAY, CONFIG.RETRY_DRAIN_RATE)
+event_history = historymodel.open_history(CONFIG.EVENT_HISTORY, CONFIG.DATABASE_PATH, CONFIG.EVENT_HISTORY_TTL, CONFIG.EVENT_HISTORY_SIZE)
+event_cursor = historymodel.EventCursor(CONFIG.DATABASE_PATH) # Newest accepted event, for the startup catch-up
+catchup_cursor = historymodel.EventCursor(CONFIG.DATABASE_PATH, "catchup") # Start of a catch-up that has not completed yet
+event_archive = archivemodel.EventArchive(CONFIG.EVENT_ARCHIVE, CONFIG.EVENT_ARCHIVE_MAX_BYTES, CONFIG.EVENT_ARCHIVE_BACKUP_COUNT) if CONFIG.EVENT_ARCHIVE else None
 
 app = sanic.Sanic(f"dinosaur-stripeconnect-{'LIVE' if CONFIG.LIVE else 'TEST'}")
 
-client = clientmodel.Client(CONFIG.DISCORD_TOKEN, CONFIG.DISCORD_GUILD_ID)
-notify = notification.DiscordNotification(CONFIG.NOTIFY_WEBHOOK)
+# With several workers, the rate limit budgets and the per-customer ordering are shared through the database
+MULTI_WORKER = CONFIG.SERVER_WORKERS > 1
+leader = workermodel.LeaderLock(f"{CONFIG.DATABASE_PATH}.leader") # Runs the singleton background tasks
+
+# One bot token: the buckets are per guild (the major parameter), the global limit is shared
+ratelimit = clientmodel.SharedRateLimiter(CONFIG.DATABASE_PATH) if MULTI_WORKER else clientmodel.RateLimiter()
+session: aiohttp.ClientSession | None = None # Shared by the guild clients and notify, opened on server start
+clients: dict[str, clientmodel.Client] = {} # guild_id -> Client
+
+def guild_client(guild_id: str) -> clientmodel.Client:
+    """Discord client of a guild, with its own member cache and request slots (created on first use)"""
+    client = clients.get(guild_id)
+    if client is None:
+        client = clients[guild_id] = clientmodel.Client(
+            CONFIG.DISCORD_TOKEN,
+            guild_id,
+            session=session,
+            ratelimit=ratelimit,
+            member_cache=cachemodel.AsyncTTLCache(CONFIG.MEMBER_CACHE_TTL, CONFIG.MEMBER_CACHE_SIZE),
+            api_base=CONFIG.DISCORD_API_BASE,
+            concurrency=CONFIG.DISCORD_GUILD_CONCURRENCY,
+        )
+    return client
+
+for guild_id in CONFIG.GUILDS:
+    guild_client(guild_id)
+notify = notification.DiscordNotification(
+    CONFIG.NOTIFY_WEBHOOK,
+    batch_window=CONFIG.NOTIFY_BATCH_WINDOW,
+    ratelimit=clientmodel.SharedRateLimiter(CONFIG.DATABASE_PATH) if MULTI_WORKER else None,
+)
+executor = workermodel.KeyedExecutor(
+    CONFIG.WORKER_CONCURRENCY,
+    CONFIG.WORKER_QUEUE_SIZE,
+    CONFIG.ORDERING_WINDOW,
+    lease=workermodel.KeyLease(CONFIG.DATABASE_PATH) if MULTI_WORKER else None,
+)
+# Role changes of a member read and replace its role list, so they run one at a time per member
+member_locks = workermodel.KeyLock(workermodel.KeyLease(CONFIG.DATABASE_PATH) if MULTI_WORKER else None)
+
+def member_lock(guild_id: str, user_id: str | int):
+    """Held while a guild member's roles are read and replaced"""
+    return member_locks.hold(f"member:{guild_id}:{user_id}")
+subscriptions = cachemodel.AsyncTTLCache(CONFIG.SUBSCRIPTION_CACHE_TTL, CONFIG.SUBSCRIPTION_CACHE_SIZE) # sub_... -> (as of, Subscription Object)
+
+async def retrieve_subscription(subscription_id: str) -> dict:
+    """Retrieve a Subscription Object, from the cache seeded by `customer.subscription.*` events if possible"""
+    _, subscription = await subscriptions.get_or_fetch(subscription_id, lambda: _retrieve_subscription(subscription_id))
+    return subscription
+
+async def _retrieve_subscription(subscription_id: str) -> tuple[float, dict]:
+    with metricsmodel.STAGE_SECONDS.time("stripe_retrieve"):
+        return time.time(), await stripe.Subscription.retrieve(subscription_id) # type: ignore
+
+def seed_subscription(event: eventmodel.StripeEvent) -> None:
+    """Cache the Subscription Object of a `customer.subscription.*` event, unless a newer one is cached
+
+    Stripe does not deliver events in order, so a late or resent event must not
+    replace the state of a newer one."""
+    cached = subscriptions.get(event.object["id"])
+    if cached is None or cached[0] <= event.created:
+        subscriptions.set(event.object["id"], (event.created, event.object))
+
+async def list_subscriptions(status: str):
+    """Stream the Subscription Objects with the status, 100 per page"""
+    page = await stripe.Subscription.list(status=status, limit=100)
+    async for subscription in page.auto_paging_iter():
+        yield subscription
+
+reconcilers: dict[str, reconcilemodel.Reconciler] = {} # guild_id -> Reconciler
+
+def guild_reconciler(guild_id: str) -> reconcilemodel.Reconciler:
+    reconciler = reconcilers.get(guild_id)
+    if reconciler is None:
+        reconciler = reconcilers[guild_id] = reconcilemodel.Reconciler(
+            guild_client(guild_id),
+            userdata,
+            CONFIG.GUILDS.get(guild_id, {}),
+            list_subscriptions,
+            lock=lambda user_id: member_lock(guild_id, user_id),
+            supersede=retry_queue.supersede,
+        )
+    return reconciler
+
+EVENTS = metricsmodel.Counter("dinosaur_events_total", "Webhook events by type and result (see REASON.md)", ("type", "status", "code"))
+EVENT_SECONDS = metricsmodel.Histogram("dinosaur_event_seconds", "Time to process an event", ("type",))
+metricsmodel.Gauge("dinosaur_queue_depth", "Jobs waiting or running", lambda: {
+    ("events",): executor.depth,
+    ("notifications",): notify.depth,
+    ("role_retries",): retry_queue.depth("pending"),
+    ("role_dead_letters",): retry_queue.depth("dead"),
+}, ("queue",))
+metricsmodel.Gauge("dinosaur_cache_hits_total", "Cache hits", lambda: {("members",): sum(c.members.hits for c in clients.values()), ("subscriptions",): subscriptions.hits}, ("cache",), kind="counter")
+metricsmodel.Gauge("dinosaur_cache_misses_total", "Cache misses", lambda: {("members",): sum(c.members.misses for c in clients.values()), ("subscriptions",): subscriptions.misses}, ("cache",), kind="counter")
+metricsmodel.Gauge("dinosaur_cache_size", "Cached entries", lambda: {("members",): sum(len(c.members) for c in clients.values()), ("subscriptions",): len(subscriptions)}, ("cache",))
+metricsmodel.Gauge("dinosaur_log_dropped_total", "Log records dropped while the log queue was full", lambda: log_handler.dropped, kind="counter")
+metricsmodel.Gauge("dinosaur_archive_dropped_total", "Events not archived while the archive queue was full", lambda: event_archive.dropped if event_archive else 0, kind="counter")
+metricsmodel.Gauge("dinosaur_discord_ratelimit_hits_total", "Discord 429 responses", lambda: {("api",): ratelimit.hits, ("webhook",): notify.ratelimit.hits}, ("client",), kind="counter")
+# With several workers, a scrape renders the samples of all of them, labeled by worker
+shared_metrics = metricsmodel.SharedMetrics(CONFIG.DATABASE_PATH, os.environ.get("SANIC_WORKER_NAME", str(os.getpid()))) if MULTI_WORKER else None
 
 @app.route("/webhook", methods=["GET", "DELETE", "HEAD", "OPTIONS", "PATCH", "PUT", "POST"])
 async def webhook(request: sanic.Request):
     if request.method != "POST":
         return response.json({"status": "error", "message": "Method not allowed", "code": 901})
 
-    event_id = request.json["id"]
+    config = CONFIG # One snapshot for the whole request, even if reloaded meanwhile
+    if config.STRIPE_WEBHOOK_SECRETS and not eventmodel.verify_signature(request.body, request.headers.get("Stripe-Signature"), config.STRIPE_WEBHOOK_SECRETS, config.STRIPE_WEBHOOK_TOLERANCE):
+        return response.json({"status": "error", "message": "Invalid signature", "code": 906}, status=400)
 
-    if event_id in event_history:
-        return response.json({"status": "success", "message": "Event already processed (Duplicate or Resend)", "code": 100})
-    else:
-        event_history.append(event_id)
-
-    data = request.json["data"]["object"]
-
-    actions = []
-
-    # logging.info(data)
-    # if data["id"] in checkout_history:
-    #     return # Skip if already processed
-    # else:
-    #     checkout_history.append(data["id"])
-
-    if request.json["type"] == "customer.subscription.deleted":
-        logging.info("Subscription Deleted Event")
-        if data["customer"] not in userdata:
-            return response.json({"status": "error", "message": "Customer not found", "code": 201})
-        user_id: str = userdata[data["customer"]]
-
-        member = await client.fetch_member(user_id)
-        if not member:
-            return response.json({"status": "error", "message": "Member not found", "code": 401})
-
-        member_id = member["user"]["id"] # Discord Snowflake MemberID
-        member_name = member["nick"] or member["user"]["username"] # Discord String Username
-
-        embeds = []
+    try:
+        event = eventmodel.StripeEvent.from_json(request.body)
+    except ValueError:
+        return response.json({"status": "error", "message": "Invalid event", "code": 907}, status=400)
+    event_id = event.id
 
-        for item in data["items"]["data"]:
-            product = item["plan"]["product"] # prod_...
+    if not event_history.add(event_id):
+        EVENTS.inc(event.type, "success", "100")
+        return response.json({"status": "success", "message": "Event already processed (Duplicate or Resend)", "code": 100})
 
-            if product not in CONFIG.ROLES:
+    future = submit_event(event, process_event if not config.ASYNC_WEBHOOK else process_queued_event)
+    if future is None:
+        event_history.discard(event_id) # Let Stripe's retry through once the queue drains
+        EVENTS.inc(event.type, "error", "903")
+        return response.json({"status": "error", "message": "Queue is full", "code": 903, "queue": executor.depth}, status=503)
+
+    if not config.ASYNC_WEBHOOK:
+        try:
+            return response.json(await asyncio.shield(future))
+        except Exception:
+            event_history.discard(event_id) # Let Stripe's retry through
+            raise
+    return response.json({"status": "success", "message": "Event queued", "code": 920, "queue": executor.depth})
+
+def submit_event(event: eventmodel.StripeEvent, job) -> asyncio.Future | None:
+    """Queue an event for `job`, move the event cursor and archive the event. Returns None if the executor is full"""
+    future = executor.submit(event_key(event), event.created, lambda: job(event))
+    if future is not None:
+        event_cursor.advance(event.id, event.created)
+        if event_archive is not None:
+            event_archive.append(event)
+    return future
+
+async def catch_up_events():
+    """Process the events created after the event cursor (e.g. while the server was down), oldest first"""
+    # Live events move event_cursor meanwhile, so an unfinished catch-up resumes from where it started
+    cursor = catchup_cursor.get() or event_cursor.get()
+    if cursor is None:
+        return # Nothing to catch up with before the first event
+    catchup_cursor.mark(*cursor)
+    logging.info("Catching up with Stripe events after %s", cursor[0])
+    queued = 0
+    try:
+        # `ending_before` pages towards newer events, yielding them oldest first
+        events = await stripe.Event.list(ending_before=cursor[0], limit=100, types=sorted(eventmodel.SUPPORTED_EVENTS))
+        async for event in events.auto_paging_iter():
+            event = eventmodel.StripeEvent.from_dict(event.to_dict_recursive()) # Same as a webhook payload
+            if not event_history.add(event.id):
                 continue
-
-
-            role_id = CONFIG.ROLES[product] # 1234567890123
-            actions.append({
-                "action": ActionType.REMOVE,
-                "role_id": role_id,
-            })
-
-            embed = notification.DiscordEmbed()
-            embed.set_title("サブスクリプションが削除されました。")
-            embed.set_description(f"ユーザー: {member_name}（<@{member_id}>）\nプラン: `{product}`")
-            embed.set_color(0xff0000)
-            embed.add_field("ステータス", "サブスクリプションが削除されました。\n`customer.subscription.deleted`", True)
-            embed.add_field("ロール状態", "削除されました。", True)
-            embed.add_field("対象ロール", f"<@&{role_id}>", True)
-            embed.set_footer(f"event_id: {event_id}")
-            embeds.append(embed)
-
-        await notify.send(embed=embeds)
-
-    elif request.json["type"] == "checkout.session.completed":
+            # Leave half of the queue to live events, and wait rather than skip if they fill it anyway
+            while executor.depth >= max(executor.max_pending // 2, 1) or submit_event(event, process_queued_event) is None:
+                await asyncio.sleep(1)
+            queued += 1
+    except Exception:
+        logging.exception("Catch-up with Stripe events failed (%d events queued)", queued)
+        return
+    catchup_cursor.clear()
+    logging.info("Caught up with Stripe events (%d events queued)", queued)
+
+def event_key(event: eventmodel.StripeEvent) -> str:
+    """Events with the same key are processed one at a time, ordered by `created`"""
+    return event.customer or event.id
+
+async def process_queued_event(event: eventmodel.StripeEvent) -> None:
+    try:
+        result = await process_event(event)
+    except Exception:
+        logging.exception("Queued event failed (%s)", event.id)
+        return
+    logging.info("Queued event processed (%s): %s %s", event.id, result["code"], result["message"])
+
+async def process_event(event: eventmodel.StripeEvent, dry_run: archivemodel.DryRun | None = None) -> dict:
+    """Process a Stripe event and return the result (see REASON.md)"""
+    event_id_token = logmodel.event_id_var.set(event.id)
+    customer_token = logmodel.customer_var.set(event.customer)
+    try:
+        with EVENT_SECONDS.time(event.type):
+            result = await handle_event(event, dry_run)
+    except Exception:
+        EVENTS.inc(event.type, "error", "exception")
+        raise
+    finally:
+        logmodel.event_id_var.reset(event_id_token)
+        logmodel.customer_var.reset(customer_token)
+    if dry_run is None:
+        event_history.complete(event.id)
+    EVENTS.inc(event.type, result["status"], str(result["code"]))
+    return result
+
+async def handle_event(event: eventmodel.StripeEvent, dry_run: archivemodel.DryRun | None = None) -> dict:
+    event_type = event.type
+    data = event.object
+    customers = userdata if dry_run is None else dry_run.customers
+    guilds = CONFIG.GUILDS # guild_id -> Product -> Role of the snapshot current when the event started
+
+    if event_type.startswith("customer.subscription."): # The payload is the full Subscription Object
+        if dry_run is None:
+            seed_subscription(event)
+        else:
+            dry_run.seed_subscription(event)
+
+    if event_type not in eventmodel.SUPPORTED_EVENTS:
+        return {"status": "success", "message": "Event not supported", "code": 900}
+
+    if event_type == eventmodel.CHECKOUT_COMPLETED:
         logging.info("Checkout Session Event")
-        # Checkout Session Event
         if len(data["custom_fields"]) < 1:
-            return response.json({"status": "error", "message": "Invalid custom field", "code": 101})
+            return {"status": "error", "message": "Invalid custom field", "code": 101}
 
         user_id: str = data["custom_fields"][0]["numeric"]["value"] # Discord Snowflake UserID
-        user_name: str = data["custom_fields"][1]["text"]["value"] # Discord UserName
 
         customer: str = data["customer"] # cus_...
-        userdata[customer] = user_id
-        asyncio.ensure_future(write_userdata(userdata))
-        subscription = await stripe.Subscription.retrieve(data["subscription"]) # type: ignore
-
-        product: str = subscription["items"]["data"][0]["plan"]["product"] # prod_...
-
-        member = await client.fetch_member(user_id)
-        if not member:
-            return response.json({"status": "error", "message": "Member not found", "code": 401})
-
-        member_name = member["nick"] or member["user"]["username"] # Discord String Username
-        member_id = member["user"]["id"] # Discord Snowflake UserID
-
-        if product not in CONFIG.ROLES:
-            return response.json({"status": "error", "message": "Product is not supported", "code": 100})
-        role_id = CONFIG.ROLES[product] # Discord Snowflake RoleID
-
-        status: str = subscription["status"]
-
-        match status:
-            case "trialing":
-                action = ActionType.ADD
-                embed = notification.DiscordEmbed()
-                embed.set_title("トライアルが開始されました！")
-                embed.set_description(f"ユーザー: {member_name}（<@{member_id}>）\nプラン: `{product}`")
-                embed.set_color(0x00ff00)
-                embed.add_field("ステータス", "トライアル中\n`checkout.session.completed`/`trialing`", True)
-                embed.add_field("ロール状態", "付与されました。（期限が切れるとロールは削除されます。）", True)
-                embed.add_field("対象ロール", f"<@&{role_id}>", True)
-                embed.set_footer(f"event_id: {event_id}")
-                await notify.send(embed=embed)
-            case "active":
-                action = ActionType.ADD
-                embed = notification.DiscordEmbed()
-                embed.set_title("サブスクリプションが開始されました！")
-                embed.set_description(f"ユーザー: {member_name}（<@{member_id}>）\nプラン: `{product}`")
-                embed.set_color(0x00ff00)
-                embed.add_field("ステータス", "サブスクリプションアクティブ\n`checkout.session.completed`/`active`", True)
-                embed.add_field("ロール状態", "付与されました。（期限が切れるとロールは削除されます。）", True)
-                embed.add_field("対象ロール", f"<@&{role_id}>", True)
-                embed.set_footer(f"event_id: {event_id}")
-                await notify.send(embed=embed)
-            case "incomplete":
-                action = ActionType.SKIP
-                embed = notification.DiscordEmbed()
-                embed.set_title("支払いを待機しています。")
-                embed.set_description(f"ユーザー: {member_name}（<@{member_id}>）\nプラン: `{product}`")
-                embed.set_color(0xffff00)
-                embed.add_field("ステータス", "購入を試みたが支払いは完了していない\n`checkout.session.completed`/`incomplete`", True)
-                embed.add_field("ロール状態", "操作は行われません。", True)
-                embed.set_footer(f"event_id: {event_id}")
-                await notify.send(embed=embed)
-            case "incomplete_expired":
-                action = ActionType.REMOVE
-                embed = notification.DiscordEmbed()
-                embed.set_title("支払いに失敗しました")
-                embed.set_description(f"ユーザー: {member_name}（<@{member_id}>）\nプラン: `{product}`")
-                embed.set_color(0xff0000)
-                embed.add_field("ステータス", "購入を試みたが支払いに失敗\n`checkout.session.completed`/`incomplete_expired`", True)
-                embed.add_field("ロール状態", "削除されました。", True)
-                embed.add_field("対象ロール", f"<@&{role_id}>", True)
-                embed.set_footer(f"event_id: {event_id}")
-                await notify.send(embed=embed)
-            case "past_due":
-                action = ActionType.REMOVE
-                embed = notification.DiscordEmbed()
-                embed.set_title("自動決済に失敗しました")
-                embed.set_description(f"ユーザー: {member_name}（<@{member_id}>）\nプラン: `{product}`")
-                embed.set_color(0xff0000)
-                embed.add_field("ステータス", "自動決済に失敗（Stripeのリトライルールに基づき再度支払いを試みる場合があります）\n`checkout.session.completed`/`past_due`", True)
-                embed.add_field("ロール状態", "削除されました。", True)
-                embed.add_field("対象ロール", f"<@&{role_id}>", True)
-                embed.set_footer(f"event_id: {event_id}")
-                await notify.send(embed=embed)
-            case "canceled":
-                action = ActionType.REMOVE
-                embed = notification.DiscordEmbed()
-                embed.set_title("支払いがキャンセルされました。")
-                embed.set_description(f"ユーザー: {member_name}（<@{member_id}>）\nプラン: `{product}`")
-                embed.set_color(0xff0000)
-                embed.add_field("ステータス", "支払いキャンセル\n`checkout.session.completed`/`canceled`", True)
-                embed.add_field("ロール状態", "削除されました。", True)
-                embed.add_field("対象ロール", f"<@&{role_id}>", True)
-                embed.set_footer(f"event_id: {event_id}")
-                await notify.send(embed=embed)
-            case "unpaid":
-                action = ActionType.REMOVE
-                embed = notification.DiscordEmbed()
-                embed.set_title("支払いは行われませんでした。")
-                embed.set_description(f"ユーザー: {member_name}（<@{member_id}>）\nプラン: `{product}`")
-                embed.set_color(0xff0000)
-                embed.add_field("ステータス", "支払いは行われませんでした。\n`checkout.session.completed`/`unpaid`", True)
-                embed.add_field("ロール状態", "削除されました。", True)
-                embed.add_field("対象ロール", f"<@&{role_id}>", True)
-                embed.set_footer(f"event_id: {event_id}")
-                await notify.send(embed=embed)
-            case _:
-                return response.json({"status": "error", "message": "Invalid payment status", "code": 102})
-
-        actions.append({
-            "action": action,
-            "role_id": role_id,
-        })
-
-    elif request.json["type"] == "customer.subscription.updated":
-        logging.info("Subscription Update Event")
-        # Subscription Update Event
-
-        if data["customer"] not in userdata:
-            return response.json({"status": "error", "message": "Customer not found", "code": 201})
-        user_id = userdata[data["customer"]] # Discord Snowflake UserID
-
-        member = await client.fetch_member(user_id)
-        if not member:
-            return response.json({"status": "error", "message": "Member not found", "code": 401})
-
-        member_name = member["nick"] or member["user"]["username"] # Discord String Username
-        member_id = member["user"]["id"] # Discord Snowflake UserID
-
-        if "previous_attributes" in request.json["data"]:
-            if "items" in request.json["data"]["previous_attributes"]:
-                logging.info("Previous attributes found")
-                for item in request.json["data"]["previous_attributes"]["items"]["data"]:
-                    # previous_product = request.json["data"]["previous_attributes"]["items"]["data"][0]["plan"]["product"] # prod_...
-                    product = item["plan"]["product"] # prod_...
-                    if product in CONFIG.ROLES:
-                        role_id = CONFIG.ROLES[product] # 1234567890123
-                        await client.del_roles(member_id, role_id)
-
-        embeds = []
-
-        for item in data["items"]["data"]:
-            product: str = item["plan"]["product"]
-
-            if product not in CONFIG.ROLES:
-                continue
-
-            role_id: str | int = CONFIG.ROLES[product] # 1234567890123
-            status: str = data["status"]
-            action: ActionType | None = None
-
-            match status:
-                case "trialing":
-                    action = ActionType.ADD
-                    embed = notification.DiscordEmbed()
-                    embed.set_title("トライアルが開始されました！")
-                    embed.set_description(f"ユーザー: {member_name}（<@{member_id}>）\nプラン: `{product}`")
-                    embed.set_color(0x00ff00)
-                    embed.add_field("ステータス", "トライアル中\n`customer.subscription.updated`/`trialing`", True)
-                    embed.add_field("ロール状態", "付与されました。（期限が切れるとロールは削除されます。）", True)
-                    embed.add_field("対象ロール", f"<@&{role_id}>", True)
-                    embed.set_footer(f"event_id: {event_id}")
-                    embeds.append(embed)
-                case "active":
-                    action = ActionType.ADD
-                    embed = notification.DiscordEmbed()
-                    embed.set_title("サブスクリプションが開始されました！")
-                    embed.set_description(f"ユーザー: {member_name}（<@{member_id}>）\nプラン: `{product}`")
-                    embed.set_color(0x00ff00)
-                    embed.add_field("ステータス", "サブスクリプションアクティブ\n`customer.subscription.updated`/`active`", True)
-                    embed.add_field("ロール状態", "付与されました。（期限が切れるとロールは削除されます。）", True)
-                    embed.add_field("対象ロール", f"<@&{role_id}>", True)
-                    embed.set_footer(f"event_id: {event_id}")
-                    embeds.append(embed)
-                case "incomplete":
-                    action = ActionType.SKIP
-                    embed = notification.DiscordEmbed()
-                    embed.set_title("支払いを待機しています。")
-                    embed.set_description(f"ユーザー: {member_name}（<@{member_id}>）\nプラン: `{product}`")
-                    embed.set_color(0xffff00)
-                    embed.add_field("ステータス", "購入を試みたが支払いは完了していない\n`customer.subscription.updated`/`incomplete`", True)
-                    embed.add_field("ロール状態", "操作は行われません。", True)
-                    embed.set_footer(f"event_id: {event_id}")
-                    embeds.append(embed)
-                case "incomplete_expired":
-                    action = ActionType.REMOVE
-                    embed = notification.DiscordEmbed()
-                    embed.set_title("支払いに失敗しました")
-                    embed.set_description(f"ユーザー: {member_name}（<@{member_id}>）\nプラン: `{product}`")
-                    embed.set_color(0xff0000)
-                    embed.add_field("ステータス", "購入を試みたが支払いに失敗\n`customer.subscription.updated`/`incomplete_expired`", True)
-                    embed.add_field("ロール状態", "削除されました。", True)
-                    embed.add_field("対象ロール", f"<@&{role_id}>", True)
-                    embed.set_footer(f"event_id: {event_id}")
-                    embeds.append(embed)
-                case "past_due":
-                    action = ActionType.REMOVE
-                    embed = notification.DiscordEmbed()
-                    embed.set_title("自動決済に失敗しました")
-                    embed.set_description(f"ユーザー: {member_name}（<@{member_id}>）\nプラン: `{product}`")
-                    embed.set_color(0xff0000)
-                    embed.add_field("ステータス", "自動決済に失敗（Stripeのリトライルールに基づき再度支払いを試みる場合があります）\n`customer.subscription.updated`/`past_due`", True)
-                    embed.add_field("ロール状態", "削除されました。", True)
-                    embed.add_field("対象ロール", f"<@&{role_id}>", True)
-                    embed.set_footer(f"event_id: {event_id}")
-                    embeds.append(embed)
-                case "canceled":
-                    action = ActionType.REMOVE
-                    embed = notification.DiscordEmbed()
-                    embed.set_title("支払いがキャンセルされました。")
-                    embed.set_description(f"ユーザー: {member_name}（<@{member_id}>）\nプラン: `{product}`")
-                    embed.set_color(0xff0000)
-                    embed.add_field("ステータス", "支払いキャンセル\n`customer.subscription.updated`/`canceled`", True)
-                    embed.add_field("ロール状態", "削除されました。", True)
-                    embed.add_field("対象ロール", f"<@&{role_id}>", True)
-                    embed.set_footer(f"event_id: {event_id}")
-                    embeds.append(embed)
-                case "unpaid":
-                    action = ActionType.REMOVE
-                    embed = notification.DiscordEmbed()
-                    embed.set_title("支払いは行われませんでした。")
-                    embed.set_description(f"ユーザー: {member_name}（<@{member_id}>）\nプラン: `{product}`")
-                    embed.set_color(0xff0000)
-                    embed.add_field("ステータス", "支払いは行われませんでした。\n`customer.subscription.updated`/`unpaid`", True)
-                    embed.add_field("ロール状態", "削除されました。", True)
-                    embed.add_field("対象ロール", f"<@&{role_id}>", True)
-                    embed.set_footer(f"event_id: {event_id}")
-                    embeds.append(embed)
-                case _:
-                    return response.json({"status": "error", "message": "Invalid payment status", "code": 202})
-
-            actions.append({
-                "action": action,
-                "role_id": role_id,
-            })
-            await notify.send(embed=embeds)
-
+        customers[customer] = user_id
+        if dry_run is None:
+            subscription = await retrieve_subscription(data["subscription"])
+        else:
+            subscription = dry_run.subscription(data["subscription"]) # Only subscription events of the replay, not Stripe
+            if subscription is None:
+                return {"status": "error", "message": "Subscription not replayed", "code": 103}
+
+        items: list[dict] = subscription["items"]["data"][:1]
+        previous_items: list[dict] = []
+        status: str | None = subscription["status"]
+        invalid_status_code = 102
     else:
-        return response.json({"status": "success", "message": "Event not supported", "code": 900})
-
-    await client.add_roles(member_id, [action["role_id"] for action in actions if action["action"] == ActionType.ADD])
-    await client.del_roles(member_id, [action["role_id"] for action in actions if action["action"] == ActionType.REMOVE])
-
-    return response.json({"status": "success", "message": "OK", "code": 500})
+        logging.info("Subscription Deleted Event" if event_type == eventmodel.SUBSCRIPTION_DELETED else "Subscription Update Event")
+        if data["customer"] not in customers:
+            return {"status": "error", "message": "Customer not found", "code": 201}
+        user_id = customers[data["customer"]] # Discord Snowflake UserID
+
+        items = data["items"]["data"]
+        previous_items = event.previous_attributes.get("items", {}).get("data", [])
+        status = data["status"] if event_type == eventmodel.SUBSCRIPTION_UPDATED else None
+        invalid_status_code = 202
+
+    # Fan out to every guild selling one of the products, concurrently so a slow guild doesn't hold up the others
+    products = {item["plan"]["product"] for item in (*items, *previous_items)}
+    targets = [guild_id for guild_id, roles in guilds.items() if not products.isdisjoint(roles)] or [next(iter(guilds))]
+    results = await asyncio.gather(*(
+        handle_guild_event(event, guild_id, guilds[guild_id], user_id, items, previous_items, status, invalid_status_code, dry_run, len(targets) > 1)
+        for guild_id in targets
+    ), return_exceptions=True)
+    errors = [(guild_id, result) for guild_id, result in zip(targets, results) if isinstance(result, BaseException)]
+    for guild_id, error in errors[1:]:
+        logging.error("Event failed in guild %s: %r", guild_id, error)
+    if errors:
+        raise errors[0][1]
+    if len(targets) == 1:
+        return results[0] # type: ignore
+    # The first failed guild decides the overall result, every guild is listed
+    result = dict(next((result for result in results if result["status"] == "error"), results[0])) # type: ignore
+    result["guilds"] = [{"guild_id": guild_id, **result} for guild_id, result in zip(targets, results)] # type: ignore
+    return result
+
+async def handle_guild_event(
+        event: eventmodel.StripeEvent,
+        guild_id: str,
+        roles: Mapping[str, str],
+        user_id: str,
+        items: list[dict],
+        previous_items: list[dict],
+        status: str | None,
+        invalid_status_code: int,
+        dry_run: archivemodel.DryRun | None,
+        label: bool
+    ) -> dict:
+    """Apply an event to one guild. `label` adds the guild to the notifications"""
+    member = await guild_client(guild_id).fetch_member(user_id) if dry_run is None else dry_run.member(user_id)
+    if not member:
+        return {"status": "error", "message": "Member not found", "code": 401}
+
+    member_id: str = member["user"]["id"] # Discord Snowflake UserID
+    member_name: str = member["nick"] or member["user"]["username"] # Discord String Username
+
+    if event.type == eventmodel.CHECKOUT_COMPLETED and items[0]["plan"]["product"] not in roles:
+        return {"status": "error", "message": "Product is not supported", "code": 100}
+
+    plan = eventmodel.plan_event(event.type, status, items, previous_items, roles, member_name, member_id, event.id)
+    if plan is None:
+        return {"status": "error", "message": "Invalid payment status", "code": invalid_status_code}
+    actions, embeds = plan
+
+    add = [action["role_id"] for action in actions if action["action"] == ActionType.ADD]
+    remove = [action["role_id"] for action in actions if action["action"] in (ActionType.REMOVE, ActionType.ADDITIONAL_REMOVE)]
+    if dry_run is not None:
+        dry_run.report(event, guild_id, member_id, add, remove)
+        return {"status": "success", "message": "OK (dry run)", "code": 500}
+
+    result = {"status": "success", "message": "OK", "code": 500}
+    async with member_lock(guild_id, member_id): # Other customers of the same member
+        retry_queue.supersede(member_id, add, remove) # This event is newer than any queued retry
+        guild_reconciler(guild_id).touch(member_id) # ...and than the subscriptions read by a running sweep
+        if await guild_client(guild_id).modify_roles(member, add=add, remove=remove) is False:
+            retry_queue.push(event_key(event), member_id, add, remove, clientmodel.MODIFY_ROLES_REASON, event.id, "Modify Guild Member failed", guild_id)
+            result = {"status": "error", "message": "Role update failed (queued for retry)", "code": 501}
+
+    for embed in embeds:
+        if label:
+            embed.add_field("サーバー", f"`{guild_id}`", True)
+        if result["code"] != 500:
+            embed.add_field("結果", "ロールの更新に失敗しました。（再試行します。）")
+    await notify.send(embed=embeds)
+    return result
+
+async def retry_role_job(job: dict) -> str | None:
+    """Retry a queued role change in order with the customer's events"""
+    future = executor.submit(job["key"], time.time(), lambda: apply_role_job(job))
+    if future is None:
+        raise retrymodel.Deferred("Executor is full")
+    return await future
+
+async def apply_role_job(job: dict) -> str | None:
+    guild_id = job["guild_id"] or CONFIG.DISCORD_GUILD_ID # Jobs queued before GUILDS are for the primary guild
+    client = guild_client(guild_id)
+    member = await client.fetch_member(job["user_id"]) # modify_roles() reads the current roles itself
+    if not member:
+        return "Member not found"
+    async with member_lock(guild_id, job["user_id"]):
+        current = retry_queue.pending(job["id"]) # Newer events may have superseded it while it waited
+        if current is None:
+            return None
+        if await client.modify_roles(member, add=current["add_roles"], remove=current["remove_roles"], reason=current["reason"]) is False:
+            return "Modify Guild Member failed"
+    return None
+
+@app.get("/metrics")
+async def metrics(request: sanic.Request):
+    if not CONFIG.METRICS:
+        return response.json({"status": "error", "message": "Metrics are disabled", "code": 905}, status=404)
+    body = shared_metrics.render() if shared_metrics is not None else metricsmodel.render()
+    return response.text(body, content_type="text/plain; version=0.0.4; charset=utf-8")
+
+def authorized(request: sanic.Request) -> bool:
+    """Check the `Authorization: Bearer <ADMIN_TOKEN>` header of an admin request"""
+    token = CONFIG.ADMIN_TOKEN
+    if not token:
+        return False
+    # As bytes: compare_digest() raises TypeError on non-ASCII str
+    return hmac.compare_digest(request.headers.get("Authorization", "").encode(), f"Bearer {token}".encode())
+
+@app.get("/admin/jobs")
+async def admin_jobs(request: sanic.Request):
+    if not authorized(request):
+        return response.json({"status": "error", "message": "Unauthorized", "code": 904}, status=401)
+    limit = request.args.get("limit", "100")
+    if not (limit.isascii() and limit.isdigit()) or int(limit) < 1:
+        return response.json({"status": "error", "message": "Invalid limit", "code": 912}, status=400)
+    jobs = retry_queue.jobs(request.args.get("status"), request.args.get("user_id"), int(limit))
+    return response.json({"status": "success", "message": "OK", "code": 910, "pending": retry_queue.depth("pending"), "dead": retry_queue.depth("dead"), "jobs": jobs})
+
+@app.post("/admin/jobs/replay")
+async def admin_replay_dead_jobs(request: sanic.Request):
+    if not authorized(request):
+        return response.json({"status": "error", "message": "Unauthorized", "code": 904}, status=401)
+    return response.json({"status": "success", "message": "OK", "code": 910, "replayed": retry_queue.replay()})
+
+@app.post("/admin/jobs/<job_id:int>/replay")
+async def admin_replay_job(request: sanic.Request, job_id: int):
+    if not authorized(request):
+        return response.json({"status": "error", "message": "Unauthorized", "code": 904}, status=401)
+    if not retry_queue.replay(job_id):
+        return response.json({"status": "error", "message": "Job not found", "code": 911}, status=404)
+    return response.json({"status": "success", "message": "OK", "code": 910, "job": retry_queue.get(job_id)})
 
 @app.listener("after_server_start")
 async def after_server_start(app, loop):
     logging.info("Server started")
+    if CONFIG.MEMBER_CACHE_WARMUP:
+        app.add_task(warm_member_cache())
+    app.add_task(run_leader_tasks(app))
+    app.add_task(watch_config())
+    if shared_metrics is not None:
+        app.add_task(shared_metrics.run())
+    if hasattr(signal, "SIGHUP"):
+        loop.add_signal_handler(signal.SIGHUP, reload_config)
+
+def reload_config() -> bool:
+    """Swap in a new snapshot of the config file. The current one is kept if the file is invalid"""
+    global CONFIG
+    try:
+        config = configmodel.load(CONFIG_PATH)
+    except Exception:
+        logging.exception("Failed to reload %s, keeping the current config", CONFIG_PATH)
+        return False
+    changed = config.changed(CONFIG)
+    restart = [key for key in changed if key not in configmodel.RELOADABLE]
+    if restart:
+        logging.warning("Changes to %s take effect after a restart", ", ".join(restart))
+    for role_id in CONFIG.MANAGED_ROLES - config.MANAGED_ROLES:
+        logging.info("Role %s is no longer managed (was %s)", role_id, ", ".join(sorted(CONFIG.PRODUCTS_BY_ROLE[role_id])))
+    CONFIG = config # A single rebinding: readers see the old or the new snapshot, never a mix
+    for guild_id, reconciler in reconcilers.items():
+        reconciler.roles = config.GUILDS.get(guild_id, {})
+    logging.info("Reloaded %s (changed: %s)", CONFIG_PATH, ", ".join(changed) or "nothing")
+    return True
+
+async def watch_config():
+    """Reload the config file when its modification time changes"""
+    mtime = os.stat(CONFIG_PATH).st_mtime_ns
+    while CONFIG.CONFIG_RELOAD_INTERVAL > 0:
+        await asyncio.sleep(CONFIG.CONFIG_RELOAD_INTERVAL)
+        try:
+            current = os.stat(CONFIG_PATH).st_mtime_ns
+        except OSError:
+            continue # e.g. replaced by an editor right now
+        if current != mtime:
+            mtime = current
+            reload_config()
+
+async def run_leader_tasks(app):
+    """Start the background tasks that must run in only one worker, once elected"""
+    await leader.wait()
+    logging.info("Elected to run the background tasks (pid %d)", os.getpid())
+    app.add_task(compact_userdata())
+    app.add_task(retry_queue.run(retry_role_job))
+    if CONFIG.RECONCILE_INTERVAL > 0:
+        app.add_task(reconcile_periodically())
+    if CONFIG.EVENT_CATCHUP:
+        app.add_task(catch_up_events())
 
     #subscription = await stripe.Subscription.retrieve(data["subscription"])
     #product = subscription["items"]["data"][0]["price"]["product"] # Product ID
@@ -380,17 +515,169 @@ async def after_server_start(app, loop):
     #else:
     #    return response.json({"status": "error", "message": "Failed to add role", "code": 2})
 
+async def warm_member_cache():
+    user_ids = set(userdata.user_ids())
+    for guild_id in CONFIG.GUILDS:
+        try:
+            await guild_client(guild_id).warm_members(user_ids)
+        except Exception:
+            logging.exception("Failed to warm up the member cache of guild %s", guild_id)
+
+async def reconcile_periodically():
+    while True:
+        await asyncio.sleep(CONFIG.RECONCILE_INTERVAL)
+        for guild_id in CONFIG.GUILDS:
+            try:
+                await guild_reconciler(guild_id).run()
+            except Exception:
+                logging.exception("Reconcile of guild %s failed", guild_id)
+
+async def reconcile(dry_run: bool):
+    open_session()
+    try:
+        for guild_id in CONFIG.GUILDS:
+            summary = await guild_reconciler(guild_id).run(dry_run, lambda user_id, add, remove: print(f"{guild_id} {user_id}: +{sorted(add)} -{sorted(remove)}"))
+            print(f"{'Dry run: ' if dry_run else ''}Guild {guild_id}: {summary['members']} members, {summary['customers']} customers, {summary['changed']} changed, {summary['failed']} failed")
+    finally:
+        await close_session()
+
+def parse_time(value: str) -> int:
+    """Unix time, or ISO 8601 date/time (UTC unless an offset is given)"""
+    if value.isdigit():
+        return int(value)
+    moment = datetime.datetime.fromisoformat(value)
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=datetime.timezone.utc)
+    return int(moment.timestamp())
+
+async def replay(args: argparse.Namespace):
+    """Process archived events again through `process_event`, without the duplicate check"""
+    if event_archive is None:
+        print("EVENT_ARCHIVE is not set")
+        return
+    events = event_archive.events(
+        parse_time(args.since) if args.since else None,
+        parse_time(args.until) if args.until else None,
+        args.customer,
+        args.type,
+    )
+    results: dict[str, int] = {} # code -> events
+    changed = 0
+
+    def count(result: dict | None) -> None:
+        code = str(result["code"]) if result else "exception"
+        results[code] = results.get(code, 0) + 1
+
+    def report(event: eventmodel.StripeEvent, guild_id: str, user_id: str, add: list[str], remove: list[str]) -> None:
+        nonlocal changed
+        if add or remove:
+            changed += 1
+            print(f"{event.id} {event.type} {event.customer} {guild_id} {user_id}: +{sorted(add)} -{sorted(remove)}")
+
+    start = time.perf_counter()
+    if args.dry_run:
+        dry_run = archivemodel.DryRun(userdata, report)
+        for event in events: # One at a time keeps every customer's events in order
+            try:
+                result = await process_event(event, dry_run)
+            except Exception:
+                logging.exception("Replayed event failed (%s)", event.id)
+                result = None
+            if result is not None and result["code"] == 103:
+                print(f"{event.id} {event.type} {event.customer}: unresolved, subscription {event.object['subscription']} not replayed")
+            count(result)
+    else:
+        open_session()
+        notify.start()
+        try:
+            for event in events:
+                while executor.depth >= executor.max_pending:
+                    await asyncio.sleep(0.1)
+                future = executor.submit(event_key(event), event.created, lambda event=event: process_event(event))
+                assert future is not None
+                future.add_done_callback(lambda future: count(None if future.cancelled() or future.exception() else future.result()))
+            while executor.depth:
+                await asyncio.sleep(0.1)
+        finally:
+            await executor.close()
+            await notify.close()
+            await close_session()
+    elapsed = time.perf_counter() - start
+    total = sum(results.values())
+    print(
+        f"{'Dry run: ' if args.dry_run else ''}{total} events in {elapsed:.1f}s ({total / elapsed if elapsed else 0:.0f}/s)"
+        + (f", {changed} role changes" if args.dry_run else "")
+        + f" (codes: {', '.join(f'{code}: {n}' for code, n in sorted(results.items()))})"
+    )
+
+def open_session() -> None:
+    """Open the HTTP session shared by the guild clients and notify"""
+    global session
+    session = clientmodel.create_session(CONFIG.HTTP_CONNECTION_LIMIT, CONFIG.HTTP_DNS_CACHE_TTL)
+    for client in clients.values():
+        client.session = session
+    notify.session = session
+
+async def close_session() -> None:
+    if session is not None and not session.closed:
+        await session.close()
+
+@app.listener("before_server_start")
+async def before_server_start(app, loop):
+    open_session()
+    notify.start()
+
+@app.listener("before_server_stop")
+async def before_server_stop(app, loop):
+    await executor.close()
+    await notify.close()
+    if event_archive is not None:
+        event_archive.close()
+
+@app.listener("after_server_stop")
+async def after_server_stop(app, loop):
+    await close_session()
+
+def forward_sighup(signum, frame):
+    """Have every Sanic server worker reload the config"""
+    for process in multiprocessing.active_children():
+        if "Server" in process.name and process.pid is not None: # Sanic-Server-<n>-<m>
+            os.kill(process.pid, signal.SIGHUP)
+
 def main():
+    parser = argparse.ArgumentParser(prog="dinosaur-stripeconnect")
+    commands = parser.add_subparsers(dest="command")
+    commands.add_parser("serve", help="Run the webhook server (default)")
+    reconcile_parser = commands.add_parser("reconcile", help="Reconcile guild roles with Stripe subscriptions")
+    reconcile_parser.add_argument("--dry-run", action="store_true", help="Print the role changes without applying them")
+    replay_parser = commands.add_parser("replay", help="Process archived events again (see EVENT_ARCHIVE)")
+    replay_parser.add_argument("--since", help="Oldest event time (Unix time or ISO 8601, UTC by default)")
+    replay_parser.add_argument("--until", help="Newest event time (Unix time or ISO 8601, UTC by default)")
+    replay_parser.add_argument("--customer", action="append", help="Stripe Customer ID (repeatable)")
+    replay_parser.add_argument("--type", action="append", help="Event type (repeatable)")
+    replay_parser.add_argument("--dry-run", action="store_true", help="Print the role changes without Discord, notifications or database writes")
+    args = parser.parse_args()
+
     print("dinosaur-stripeconnect")
     read_userdata()
+    if args.command == "reconcile":
+        asyncio.run(reconcile(args.dry_run))
+        return
+    if args.command == "replay":
+        asyncio.run(replay(args))
+        return
     if CONFIG.LIVE:
         print("""\
 ########## ATTENTION! ##########
 You are running this in LIVE mode.
 ################################""")
     print(f"The webhook url is 'http://localhost:{CONFIG.SERVER_PORT}/webhook' (localrun)")
+    if not CONFIG.STRIPE_WEBHOOK_SECRETS:
+        print("WARNING: STRIPE_WEBHOOK_SECRET is not set, so webhook signatures are not verified.")
+    if hasattr(signal, "SIGHUP"):
+        signal.signal(signal.SIGHUP, forward_sighup) # This process only manages the Sanic workers
 
-    app.run("0.0.0.0", CONFIG.SERVER_PORT)
+    app.run("0.0.0.0", CONFIG.SERVER_PORT, workers=CONFIG.SERVER_WORKERS)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,193 @@
+import asyncio
+import bisect
+import json
+import sqlite3
+import time
+from typing import Callable, Iterable
+
+# Every metric is only touched from the event loop thread, so recording is a plain
+# dict update without locks.
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+LabelValues = tuple[str, ...]
+LabelPairs = tuple[tuple[str, str], ...]
+Family = tuple[str, str, str, list] # (name, help, kind, [(sample name, label pairs, value), ...])
+
+REGISTRY: list["Metric"] = []
+
+class Metric:
+    """Base of the metrics rendered in the Prometheus text format"""
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        REGISTRY.append(self)
+
+    def samples(self) -> Iterable[tuple[str, LabelValues, LabelPairs, float]]:
+        """(name suffix, label values, extra label pairs, value)"""
+        raise NotImplementedError
+
+    def family(self, labels: LabelPairs = ()) -> Family:
+        """The samples with their label pairs, `labels` (e.g. the worker) first"""
+        samples = [
+            (f"{self.name}{suffix}", (*labels, *zip(self.labels, values), *extra), value)
+            for suffix, values, extra, value in self.samples()
+        ]
+        return self.name, self.help, self.kind, samples
+
+    def render(self) -> str:
+        return _render_family(*self.family())
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = ()) -> None:
+        super().__init__(name, help, labels)
+        self._values: dict[LabelValues, float] = {}
+
+    def inc(self, *values: str, amount: float = 1) -> None:
+        self._values[values] = self._values.get(values, 0) + amount
+
+    def samples(self):
+        for values, value in self._values.items():
+            yield "", values, (), value
+
+class Gauge(Metric):
+    """Value read on every scrape, e.g. a queue depth owned by another object
+
+    `collect` returns the value, or a dict of label values -> value."""
+    def __init__(self, name: str, help: str, collect: Callable[[], float | dict[LabelValues, float]], labels: Iterable[str] = (), kind: str = "gauge") -> None:
+        super().__init__(name, help, labels)
+        self.collect = collect
+        self.kind = kind # "counter" for totals kept elsewhere
+
+    def samples(self):
+        value = self.collect()
+        if not isinstance(value, dict):
+            value = {(): value}
+        for values, v in value.items():
+            yield "", values, (), v
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = (), buckets: Iterable[float] = DEFAULT_BUCKETS) -> None:
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+        self._values: dict[LabelValues, list[float]] = {} # label values -> [count per bucket..., +Inf, sum]
+
+    def observe(self, value: float, *values: str) -> None:
+        counts = self._values.get(values)
+        if counts is None:
+            counts = self._values[values] = [0] * (len(self.buckets) + 2)
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def time(self, *values: str) -> "Timer":
+        """Context manager observing the seconds spent in its block"""
+        return Timer(self, values)
+
+    def samples(self):
+        for values, counts in self._values.items():
+            total = 0
+            for bound, count in zip(self.buckets, counts):
+                total += count
+                yield "_bucket", values, (("le", _number(bound)),), total
+            total += counts[-2]
+            yield "_bucket", values, (("le", "+Inf"),), total
+            yield "_sum", values, (), counts[-1]
+            yield "_count", values, (), total
+
+class Timer:
+    __slots__ = ("histogram", "values", "start")
+
+    def __init__(self, histogram: Histogram, values: LabelValues) -> None:
+        self.histogram = histogram
+        self.values = values
+        self.start = 0.0
+
+    def __enter__(self) -> "Timer":
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.histogram.observe(time.perf_counter() - self.start, *self.values)
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def _number(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def _render_family(name: str, help: str, kind: str, samples: list) -> str:
+    lines = [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+    for sample, pairs, value in samples:
+        labels = ",".join(f'{label}="{_escape(v)}"' for label, v in pairs)
+        lines.append(f"{sample}{'{' + labels + '}' if labels else ''} {_number(value)}")
+    return "\n".join(lines)
+
+def collect(registry: list[Metric] | None = None, labels: LabelPairs = ()) -> list[Family]:
+    return [metric.family(labels) for metric in (REGISTRY if registry is None else registry)]
+
+def render_collected(collected: Iterable[list[Family]]) -> str:
+    """Several collect() results (e.g. one per worker) merged into one exposition
+
+    The text format needs all samples of a metric under a single HELP/TYPE header."""
+    families: dict[str, Family] = {}
+    for metrics in collected:
+        for name, help, kind, samples in metrics:
+            if name in families:
+                families[name][3].extend(samples)
+            else:
+                families[name] = (name, help, kind, list(samples))
+    return "\n".join(_render_family(*family) for family in families.values()) + "\n"
+
+def render(registry: list[Metric] | None = None) -> str:
+    """All metrics in the Prometheus text exposition format"""
+    return render_collected([collect(registry)])
+
+class SharedMetrics:
+    """Metrics of every Sanic worker through SQLite
+
+    A scrape lands on any one worker, so each worker publishes its samples with a
+    `worker` label and the scraped one renders them all. The other workers' samples
+    are up to `interval` seconds old."""
+    def __init__(self, path: str, worker: str, interval: float = 5, ttl: float = 300, registry: list[Metric] | None = None) -> None:
+        self.registry = registry
+        self.worker = worker # e.g. the Sanic worker name, stable across restarts
+        self.interval = interval # Seconds between publishes
+        self.ttl = ttl # Seconds before the samples of a worker that stopped publishing are dropped
+        self._db = sqlite3.connect(path, isolation_level=None, check_same_thread=False, timeout=5)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS metric_snapshots (worker TEXT PRIMARY KEY, updated_at REAL NOT NULL, families TEXT NOT NULL) WITHOUT ROWID")
+
+    def publish(self) -> list[Family]:
+        collected = collect(self.registry, labels=(("worker", self.worker),))
+        self._db.execute(
+            "INSERT INTO metric_snapshots (worker, updated_at, families) VALUES (?, ?, ?) "
+            "ON CONFLICT (worker) DO UPDATE SET updated_at = excluded.updated_at, families = excluded.families",
+            (self.worker, time.time(), json.dumps(collected)),
+        )
+        return collected
+
+    def render(self) -> str:
+        """Fresh samples of this worker and the last published ones of the others"""
+        collected = [self.publish()]
+        rows = self._db.execute("SELECT families FROM metric_snapshots WHERE worker != ? AND updated_at >= ? ORDER BY worker", (self.worker, time.time() - self.ttl))
+        collected.extend(json.loads(families) for families, in rows)
+        return render_collected(collected)
+
+    async def run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            self.publish()
+
+    def close(self) -> None:
+        self._db.close()
+
+# Latency of outbound calls: stripe_retrieve, fetch_member, modify_roles, notify_post
+STAGE_SECONDS = Histogram("dinosaur_stage_seconds", "Latency of outbound calls by stage", ("stage",))
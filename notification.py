@@ -1,17 +1,32 @@
 import aiohttp
 import asyncio
+import logging
+import random
+
+import clientmodel
+import metricsmodel
 
 class DiscordEmbed:
-    title: str | None = None
-    description: str | None = None
-    url: str | None = None
-    timestamp: str | None = None
-    color: int = 0x000000
-    footer: dict[str, str | None] = {}
-    image: dict[str, str] = {}
-    thumbnail: dict[str, str] = {}
-    author: dict[str, str] = {}
-    fields: list[dict[str, str | bool]] = []
+    __slots__ = ("title", "description", "url", "timestamp", "color", "footer", "image", "thumbnail", "author", "fields")
+
+    def __init__(
+            self,
+            title: str | None = None,
+            description: str | None = None,
+            color: int = 0x000000,
+            fields: list[dict[str, str | bool]] | None = None,
+            footer: dict[str, str] | None = None
+        ):
+        self.title: str | None = title
+        self.description: str | None = description
+        self.url: str | None = None
+        self.timestamp: str | None = None
+        self.color: int = color
+        self.footer: dict[str, str] | None = footer
+        self.image: dict[str, str] | None = None
+        self.thumbnail: dict[str, str] | None = None
+        self.author: dict[str, str] | None = None
+        self.fields: list[dict[str, str | bool]] = fields if fields is not None else []
 
     def set_title(self, title: str):
         self.title = title
@@ -29,10 +44,9 @@ class DiscordEmbed:
         self.color = color
 
     def set_footer(self, text: str, icon_url: str | None = None):
-        self.footer = {
-            "text": text,
-            "icon_url": icon_url
-        }
+        self.footer = {"text": text}
+        if icon_url:
+            self.footer["icon_url"] = icon_url
 
     def set_image(self, url: str):
         self.image = {
@@ -59,18 +73,38 @@ class DiscordEmbed:
         })
 
     def get_embed(self):
-        return {
-            "title": self.title,
-            "description": self.description,
-            "url": self.url,
-            "timestamp": self.timestamp,
-            "color": self.color,
-            "footer": self.footer,
-            "image": self.image,
-            "thumbnail": self.thumbnail,
-            "author": self.author,
-            "fields": self.fields
-        }
+        """Embed Object for the Discord API (empty keys are left out)"""
+        embed: dict = {"color": self.color}
+        for key in ("title", "description", "url", "timestamp", "footer", "image", "thumbnail", "author", "fields"):
+            value = getattr(self, key)
+            if value:
+                embed[key] = value
+        return embed
+
+class EmbedTemplate:
+    """Prebuilt status embed that only differs by member, product, role and event_id"""
+    __slots__ = ("title", "color", "fields", "role_field")
+
+    def __init__(self, title: str, color: int, status: str, role_state: str, role_field: bool = True):
+        self.title = title
+        self.color = color
+        self.fields: tuple[dict[str, str | bool], ...] = (
+            {"name": "ステータス", "value": status, "inline": True},
+            {"name": "ロール状態", "value": role_state, "inline": True},
+        )
+        self.role_field = role_field # Add the "対象ロール" field
+
+    def render(self, member_name: str, member_id: str | int, product: str, role_id: str | int, event_id: str) -> DiscordEmbed:
+        fields = list(self.fields)
+        if self.role_field:
+            fields.append({"name": "対象ロール", "value": f"<@&{role_id}>", "inline": True})
+        return DiscordEmbed(
+            title=self.title,
+            description=f"ユーザー: {member_name}（<@{member_id}>）\nプラン: `{product}`",
+            color=self.color,
+            fields=fields,
+            footer={"text": f"event_id: {event_id}"},
+        )
 
 class DiscordNotification:
     def __init__(
@@ -78,11 +112,53 @@ class DiscordNotification:
             webhook_url: str,
             username: str = "DinosaurStripeConnect",
             avatar_url: str = "",
-            loop: asyncio.AbstractEventLoop | None = None
+            loop: asyncio.AbstractEventLoop | None = None,
+            session: aiohttp.ClientSession | None = None,
+            batch_window: float = 2.0,
+            max_retries: int = 3,
+            max_queue: int = 1000,
+            ratelimit: clientmodel.RateLimiter | None = None
         ):
         self.webhook_url = webhook_url
         self.username = username
         self.avatar_url = avatar_url
+        self.session = session # Shared HTTP Session (see clientmodel.create_session)
+        self.batch_window = batch_window # Seconds to wait for more embeds before posting
+        self.max_embeds = 10 # Max embeds per webhook message (Discord limit)
+        self.max_retries = max_retries
+        self.max_queue = max_queue
+        self.ratelimit = ratelimit or clientmodel.RateLimiter()
+        self._queue: asyncio.Queue[DiscordEmbed | None] | None = None # None stops the dispatcher
+        self._dispatcher: asyncio.Task | None = None
+
+    @property
+    def depth(self) -> int:
+        """Number of embeds waiting to be posted"""
+        return self._queue.qsize() if self._queue else 0
+
+    def start(self) -> None:
+        """Start the background dispatcher which batches embeds (must be called inside the event loop)"""
+        if self._dispatcher is not None or self.batch_window <= 0:
+            return
+        self._queue = asyncio.Queue(self.max_queue)
+        self._dispatcher = asyncio.create_task(self._dispatch())
+
+    async def close(self, timeout: float = 10) -> None:
+        """Post the queued embeds and stop the dispatcher"""
+        if self._dispatcher is None or self._queue is None:
+            return
+        await self._queue.put(None) # Everything queued before this is posted first
+        try:
+            await asyncio.wait_for(self._dispatcher, timeout)
+        except asyncio.TimeoutError:
+            logging.warning("Notification dispatcher closed with %d queued embeds", self.depth)
+        self._dispatcher = None
+        self._queue = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession()
+        return self.session
 
     def get_content(self, message: str | None = None, embed: list[DiscordEmbed] | None = None):
         if embed:
@@ -100,7 +176,69 @@ class DiscordNotification:
             }
 
     async def send(self, message: str | None = None, embed: DiscordEmbed | list[DiscordEmbed] | None = None):
+        """Send a notification. Embeds without a message are queued when the dispatcher is running"""
         if isinstance(embed, DiscordEmbed):
             embed = [embed]
-        async with aiohttp.ClientSession() as session:
-            await session.post(self.webhook_url, json=self.get_content(message, embed))
+        if message is None and self._queue is not None:
+            for e in embed or ():
+                try:
+                    self._queue.put_nowait(e)
+                except asyncio.QueueFull:
+                    logging.warning("Notification queue is full, dropping an embed (%s)", e.title)
+            return
+        if message is None and not embed:
+            return
+        for i in range(0, max(len(embed or ()), 1), self.max_embeds):
+            await self._post(self.get_content(message, embed[i:i + self.max_embeds] if embed else None))
+
+    async def _dispatch(self) -> None:
+        assert self._queue is not None
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            first = await self._queue.get()
+            if first is None:
+                return
+            batch = [first]
+            deadline = loop.time() + self.batch_window
+            while len(batch) < self.max_embeds:
+                try:
+                    embed = await asyncio.wait_for(self._queue.get(), deadline - loop.time())
+                except asyncio.TimeoutError:
+                    break
+                if embed is None:
+                    stopping = True
+                    break
+                batch.append(embed)
+            try:
+                await self._post(self.get_content(embed=batch))
+            except Exception:
+                logging.exception("Failed to post %d notification embeds", len(batch))
+
+    async def _post(self, content: dict) -> bool:
+        """Post to the webhook, waiting for rate limits and retrying failures with backoff"""
+        with metricsmodel.STAGE_SECONDS.time("notify_post"):
+            return await self._post_with_retries(content)
+
+    async def _post_with_retries(self, content: dict) -> bool:
+        route = "POST /webhooks/{webhook_id}/{webhook_token}"
+        for attempt in range(self.max_retries + 1):
+            bucket = await self.ratelimit.acquire(route, self.webhook_url)
+            status, headers, data = 0, None, None
+            try:
+                async with self._get_session().post(self.webhook_url, json=content) as resp:
+                    status, headers = resp.status, resp.headers
+                    data = await resp.json() if resp.content_type == "application/json" else None
+            except aiohttp.ClientError as e:
+                logging.warning("Notification post failed: %s", e)
+            finally:
+                retry_after = await self.ratelimit.update(route, self.webhook_url, bucket, status, headers, data)
+            if status < 300 and status != 0:
+                return True
+            if retry_after is None and status != 0 and status < 500:
+                logging.error("Notification post rejected (%s): %s", status, data)
+                return False
+            if retry_after is None:
+                await asyncio.sleep(2 ** attempt + random.random())
+        logging.error("Notification post gave up after %d attempts", self.max_retries + 1)
+        return False
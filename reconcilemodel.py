@@ -0,0 +1,115 @@
+import contextlib
+import logging
+from typing import AsyncContextManager, AsyncIterator, Callable, Mapping
+
+import clientmodel
+import eventmodel
+import userdatamodel
+
+RECONCILE_REASON = "Reconciled with Stripe subscriptions. (dinosaur-stripeconnect)"
+
+# Subscription statuses that grant the product's role
+GRANTING_STATUSES = frozenset(status for status, entry in eventmodel.STATUSES.items() if entry[0] == eventmodel.ActionType.ADD)
+
+class Reconciler:
+    """Bulk reconciliation between Stripe subscriptions and guild roles
+
+    Streams the granting subscriptions once to build the roles each known Discord user
+    should have, then pages through the guild and applies the minimal role delta to
+    every member that is a known customer. Members are never held beyond their page.
+    Members whose roles were changed by an event during the sweep (see `touch`) are
+    skipped, as the subscriptions read at the start may already be outdated for them.
+    A change is applied under the same per-member `lock` as the events, and supersedes
+    their queued retries."""
+    def __init__(
+            self,
+            client: clientmodel.Client,
+            userdata: userdatamodel.UserData,
+            roles: Mapping[str, str],
+            list_subscriptions: Callable[[str], AsyncIterator[dict]],
+            lock: Callable[[str], AsyncContextManager] | None = None,
+            supersede: Callable[[str, set[str], set[str]], None] | None = None
+        ) -> None:
+        self.client = client
+        self.userdata = userdata
+        self.roles = roles # Product -> Role, replaced when the config is reloaded
+        self.list_subscriptions = list_subscriptions # status -> Subscription Objects
+        self.lock = lock # user_id -> lock held while the member's roles are changed
+        self.supersede = supersede # (user_id, add, remove), drops the overridden parts of queued retries
+        self._touched: set[str] | None = None # Users changed by events during the running sweep
+
+    @property
+    def running(self) -> bool:
+        return self._touched is not None
+
+    def touch(self, user_id: str | int) -> None:
+        """Record that an event changed the user's roles while a sweep is running"""
+        if self._touched is not None:
+            self._touched.add(str(user_id))
+
+    async def desired_roles(self, roles: Mapping[str, str] | None = None) -> dict[str, set[str]]:
+        """Discord User -> managed roles they should have"""
+        roles = self.roles if roles is None else roles
+        desired: dict[str, set[str]] = {}
+        for status in GRANTING_STATUSES:
+            async for subscription in self.list_subscriptions(status):
+                user_id = self.userdata.get(subscription["customer"])
+                if user_id is None:
+                    continue
+                for item in subscription["items"]["data"]:
+                    role_id = roles.get(item["plan"]["product"])
+                    if role_id is not None:
+                        desired.setdefault(user_id, set()).add(role_id)
+        return desired
+
+    async def run(self, dry_run: bool = False, report: Callable[[str, set[str], set[str]], None] | None = None) -> dict[str, int]:
+        """Reconcile every known customer's roles. Returns a summary of the sweep"""
+        if self._touched is not None:
+            raise RuntimeError("Reconcile is already running")
+        self._touched = set()
+        try:
+            return await self._run(dry_run, report)
+        finally:
+            self._touched = None
+
+    async def _run(self, dry_run: bool, report: Callable[[str, set[str], set[str]], None] | None) -> dict[str, int]:
+        assert self._touched is not None
+        roles = self.roles # The whole sweep uses the roles configured when it started
+        managed = set(roles.values())
+        desired = await self.desired_roles(roles)
+        summary = {"members": 0, "customers": 0, "changed": 0, "skipped": 0, "failed": 0}
+        async for members in self.client.iter_members():
+            summary["members"] += len(members)
+            for member in members:
+                user_id = member["user"]["id"]
+                want = desired.get(user_id)
+                if want is None:
+                    if not self.userdata.has_user(user_id):
+                        continue # Never touch roles of members who are not customers
+                    want = set()
+                summary["customers"] += 1
+                current = set(member.get("roles", [])) & managed
+                add, remove = want - current, current - want
+                if not add and not remove:
+                    continue
+                if user_id in self._touched:
+                    summary["skipped"] += 1
+                    continue
+                if report is not None:
+                    report(user_id, add, remove)
+                logging.info("Reconcile %s: +%s -%s%s", user_id, sorted(add), sorted(remove), " (dry run)" if dry_run else "")
+                if dry_run:
+                    summary["changed"] += 1
+                    continue
+                async with self.lock(user_id) if self.lock is not None else contextlib.nullcontext():
+                    if user_id in self._touched: # Changed by an event while waiting for the lock
+                        summary["skipped"] += 1
+                        continue
+                    if self.supersede is not None:
+                        self.supersede(user_id, add, remove)
+                    if await self.client.modify_roles(member, add=add, remove=remove, reason=RECONCILE_REASON) is False:
+                        summary["failed"] += 1
+                    else:
+                        summary["changed"] += 1
+        logging.info("Reconcile finished: %s", summary)
+        return summary
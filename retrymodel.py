@@ -0,0 +1,156 @@
+import asyncio
+import json
+import logging
+import random
+import sqlite3
+import time
+from typing import Awaitable, Callable, Iterable
+
+class Deferred(Exception):
+    """Raised by a handler that cannot run the job now (e.g. the executor is full), to retry it without counting an attempt"""
+
+class RetryQueue:
+    """Persistent queue of failed role changes for dinosaur-stripeconnect
+
+    Jobs are retried with exponential backoff and full jitter, and are moved to the
+    dead letters (status `dead`) after `max_attempts` failures."""
+    def __init__(self, path: str, max_attempts: int = 8, base_delay: float = 5, max_delay: float = 3600, drain_rate: float = 5) -> None:
+        self.path = path
+        self.max_attempts = max_attempts # Attempts before a job is dead-lettered
+        self.base_delay = base_delay # Seconds before the first retry
+        self.max_delay = max_delay # Max seconds between retries
+        self.drain_rate = drain_rate # Max jobs retried per second
+        self._db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS role_jobs ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "key TEXT NOT NULL, "
+            "user_id TEXT NOT NULL, "
+            "add_roles TEXT NOT NULL, "
+            "remove_roles TEXT NOT NULL, "
+            "reason TEXT NOT NULL, "
+            "event_id TEXT, "
+            "status TEXT NOT NULL DEFAULT 'pending', "
+            "attempts INTEGER NOT NULL DEFAULT 0, "
+            "next_run_at REAL NOT NULL, "
+            "last_error TEXT, "
+            "created REAL NOT NULL)"
+        )
+        if "guild_id" not in {row["name"] for row in self._db.execute("PRAGMA table_info(role_jobs)")}:
+            self._db.execute("ALTER TABLE role_jobs ADD COLUMN guild_id TEXT") # NULL: jobs queued before guilds were recorded
+        self._db.execute("CREATE INDEX IF NOT EXISTS role_jobs_due ON role_jobs (status, next_run_at)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS role_jobs_user_id ON role_jobs (user_id)")
+
+    @staticmethod
+    def _job(row: sqlite3.Row) -> dict:
+        job = dict(row)
+        job["add_roles"] = json.loads(job["add_roles"])
+        job["remove_roles"] = json.loads(job["remove_roles"])
+        return job
+
+    def depth(self, status: str = "pending") -> int:
+        return self._db.execute("SELECT COUNT(*) FROM role_jobs WHERE status = ?", (status,)).fetchone()[0]
+
+    def push(self, key: str, user_id: str | int, add: Iterable[str | int], remove: Iterable[str | int], reason: str, event_id: str | None = None, error: str | None = None, guild_id: str | None = None) -> int:
+        """Queue a role change that failed, to be retried after the first backoff"""
+        now = time.time()
+        cursor = self._db.execute(
+            "INSERT INTO role_jobs (key, user_id, add_roles, remove_roles, reason, event_id, attempts, next_run_at, last_error, created, guild_id) VALUES (?, ?, ?, ?, ?, ?, 1, ?, ?, ?, ?)",
+            (key, str(user_id), json.dumps(sorted({str(r) for r in add})), json.dumps(sorted({str(r) for r in remove})), reason, event_id, now + self._backoff(1), error, now, guild_id),
+        )
+        logging.warning("Role change for %s queued for retry (job %s): %s", user_id, cursor.lastrowid, error)
+        return cursor.lastrowid # type: ignore
+
+    def supersede(self, user_id: str | int, add: Iterable[str | int], remove: Iterable[str | int]) -> None:
+        """Drop the parts of pending jobs that a newer role change for the user overrides"""
+        add, remove = {str(r) for r in add}, {str(r) for r in remove}
+        if not add and not remove:
+            return
+        for job in self.jobs("pending", user_id=user_id):
+            job_add = set(job["add_roles"]) - remove
+            job_remove = set(job["remove_roles"]) - add
+            if not job_add and not job_remove:
+                self._db.execute("DELETE FROM role_jobs WHERE id = ?", (job["id"],))
+            elif job_add != set(job["add_roles"]) or job_remove != set(job["remove_roles"]):
+                self._db.execute("UPDATE role_jobs SET add_roles = ?, remove_roles = ? WHERE id = ?", (json.dumps(sorted(job_add)), json.dumps(sorted(job_remove)), job["id"]))
+
+    def jobs(self, status: str | None = None, user_id: str | int | None = None, limit: int = 100) -> list[dict]:
+        query, params = "SELECT * FROM role_jobs WHERE 1", []
+        if status is not None:
+            query += " AND status = ?"
+            params.append(status)
+        if user_id is not None:
+            query += " AND user_id = ?"
+            params.append(str(user_id))
+        query += " ORDER BY id LIMIT ?"
+        params.append(limit)
+        return [self._job(row) for row in self._db.execute(query, params)]
+
+    def get(self, job_id: int) -> dict | None:
+        row = self._db.execute("SELECT * FROM role_jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._job(row) if row else None
+
+    def pending(self, job_id: int) -> dict | None:
+        """The job as it is now, or None if it is no longer pending (e.g. superseded by a newer event)"""
+        job = self.get(job_id)
+        return job if job is not None and job["status"] == "pending" else None
+
+    def replay(self, job_id: int | None = None) -> int:
+        """Make a job (or every dead job) due now with a fresh attempt count"""
+        if job_id is None:
+            cursor = self._db.execute("UPDATE role_jobs SET status = 'pending', attempts = 0, next_run_at = ? WHERE status = 'dead'", (time.time(),))
+        else:
+            cursor = self._db.execute("UPDATE role_jobs SET status = 'pending', attempts = 0, next_run_at = ? WHERE id = ?", (time.time(), job_id))
+        return cursor.rowcount
+
+    def complete(self, job_id: int) -> None:
+        self._db.execute("DELETE FROM role_jobs WHERE id = ?", (job_id,))
+
+    def fail(self, job: dict, error: str) -> None:
+        attempts = job["attempts"] + 1
+        if attempts >= self.max_attempts:
+            self._db.execute("UPDATE role_jobs SET status = 'dead', attempts = ?, last_error = ? WHERE id = ?", (attempts, error, job["id"]))
+            logging.error("Role change job %s dead-lettered after %d attempts: %s", job["id"], attempts, error)
+        else:
+            self._db.execute("UPDATE role_jobs SET attempts = ?, next_run_at = ?, last_error = ? WHERE id = ?", (attempts, time.time() + self._backoff(attempts), error, job["id"]))
+
+    def defer(self, job: dict) -> None:
+        """Run the job again after the first backoff, keeping its attempts"""
+        self._db.execute("UPDATE role_jobs SET next_run_at = ? WHERE id = ?", (time.time() + self.base_delay, job["id"]))
+
+    def _backoff(self, attempts: int) -> float:
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempts - 1)))
+
+    def _due(self, limit: int) -> list[dict]:
+        rows = self._db.execute("SELECT * FROM role_jobs WHERE status = 'pending' AND next_run_at <= ? ORDER BY next_run_at LIMIT ?", (time.time(), limit))
+        return [self._job(row) for row in rows]
+
+    async def run(self, handler: Callable[[dict], Awaitable[str | None]], poll_interval: float = 1) -> None:
+        """Drain due jobs forever. `handler` returns None on success or an error message"""
+        while True:
+            jobs = self._due(max(1, int(self.drain_rate)))
+            if not jobs:
+                await asyncio.sleep(poll_interval)
+                continue
+            for job in jobs:
+                job = self.get(job["id"])
+                if job is None or job["status"] != "pending":
+                    continue # Superseded or replayed while waiting
+                try:
+                    error = await handler(job)
+                except Deferred as e:
+                    logging.info("Role change job %s deferred: %s", job["id"], e)
+                    self.defer(job)
+                    break # The remaining due jobs would be declined as well
+                except Exception as e:
+                    logging.exception("Role change job %s failed", job["id"])
+                    error = repr(e)
+                if error is None:
+                    self.complete(job["id"])
+                    logging.info("Role change job %s succeeded", job["id"])
+                else:
+                    self.fail(job, error)
+                await asyncio.sleep(1 / self.drain_rate)
@@ -0,0 +1,20 @@
+import unittest
+
+import archivemodel
+from eventmodel import StripeEvent
+
+def subscription_event(id: str, created: int, status: str) -> StripeEvent:
+    return StripeEvent(id, "customer.subscription.updated", created, {"id": "sub_1", "customer": "cus_1", "status": status})
+
+class DryRunTest(unittest.TestCase):
+    def test_subscription_of_replayed_events(self):
+        dry_run = archivemodel.DryRun({}, lambda *args: None)
+        self.assertIsNone(dry_run.subscription("sub_1")) # Not replayed, and Stripe is not asked
+        dry_run.seed_subscription(subscription_event("evt_2", 200, "past_due"))
+        dry_run.seed_subscription(subscription_event("evt_1", 100, "active")) # Older, archived late
+        self.assertEqual(dry_run.subscription("sub_1")["status"], "past_due")
+        dry_run.seed_subscription(subscription_event("evt_3", 300, "active"))
+        self.assertEqual(dry_run.subscription("sub_1")["status"], "active")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,83 @@
+import json
+import unittest
+
+import eventmodel
+
+SECRET = b"whsec_test"
+OLD_SECRET = b"whsec_old"
+PAYLOAD = json.dumps({"id": "evt_1", "type": "customer.subscription.deleted", "created": 1700000000, "data": {"object": {"customer": "cus_1"}}}).encode()
+NOW = 1700000000
+
+class VerifySignatureTest(unittest.TestCase):
+    def verify(self, header: str | None, secrets: list[bytes] = [SECRET], payload: bytes = PAYLOAD) -> bool:
+        return eventmodel.verify_signature(payload, header, secrets, tolerance=300, now=NOW)
+
+    def test_valid(self):
+        self.assertTrue(self.verify(eventmodel.sign_payload(PAYLOAD, SECRET, NOW)))
+
+    def test_tampered_payload(self):
+        self.assertFalse(self.verify(eventmodel.sign_payload(PAYLOAD, SECRET, NOW), payload=PAYLOAD + b" "))
+
+    def test_wrong_secret(self):
+        self.assertFalse(self.verify(eventmodel.sign_payload(PAYLOAD, b"whsec_other", NOW)))
+
+    def test_stale(self):
+        self.assertFalse(self.verify(eventmodel.sign_payload(PAYLOAD, SECRET, NOW - 301)))
+        self.assertFalse(self.verify(eventmodel.sign_payload(PAYLOAD, SECRET, NOW + 301)))
+        self.assertTrue(self.verify(eventmodel.sign_payload(PAYLOAD, SECRET, NOW - 300)))
+
+    def test_rotated_secret(self):
+        # Stripe signs with every active secret while one is rolled
+        old = eventmodel.sign_payload(PAYLOAD, OLD_SECRET, NOW)
+        new = eventmodel.sign_payload(PAYLOAD, SECRET, NOW)
+        header = f"{new},v1={old.split('v1=')[1]}"
+        self.assertTrue(self.verify(old, [SECRET, OLD_SECRET]))
+        self.assertTrue(self.verify(header, [OLD_SECRET]))
+        self.assertTrue(self.verify(header, [SECRET]))
+        self.assertFalse(self.verify(old, [SECRET]))
+
+    def test_malformed(self):
+        signature = eventmodel.sign_payload(PAYLOAD, SECRET, NOW).split("v1=")[1]
+        for header in (
+            None,
+            "",
+            "garbage",
+            f"v1={signature}", # No timestamp
+            f"t={NOW}", # No signature
+            f"t=abc,v1={signature}",
+            f"t=²,v1={signature}", # Unicode digit
+            f"t=-{NOW},v1={signature}",
+            f"t={NOW},v0={signature}", # Only v1 is accepted
+            f"t={NOW},v1={signature}" + ",v1=x" * eventmodel.MAX_SIGNATURE_HEADER,
+        ):
+            with self.subTest(header=header):
+                self.assertFalse(self.verify(header))
+
+    def test_no_secrets(self):
+        self.assertFalse(self.verify(eventmodel.sign_payload(PAYLOAD, SECRET, NOW), []))
+
+class StripeEventTest(unittest.TestCase):
+    def test_from_json(self):
+        event = eventmodel.StripeEvent.from_json(PAYLOAD)
+        self.assertEqual((event.id, event.type, event.created, event.customer), ("evt_1", "customer.subscription.deleted", 1700000000, "cus_1"))
+
+    def test_invalid(self):
+        for body in (
+            b"\xff",
+            b"not json",
+            b"[]",
+            b'{"id": "evt_1"}',
+            b'{"id": 1, "type": "x", "created": 1, "data": {"object": {}}}',
+            b'{"id": "evt_1", "type": ["x"], "created": 1, "data": {"object": {}}}',
+            b'{"id": "evt_1", "type": "x", "created": "1", "data": {"object": {}}}',
+            b'{"id": "evt_1", "type": "x", "created": true, "data": {"object": {}}}',
+            b'{"id": "evt_1", "type": "x", "created": 1, "data": {"object": []}}',
+            b'{"id": "evt_1", "type": "x", "created": 1, "data": []}',
+            b'{"id": "evt_1", "type": "x", "created": 1, "data": {"object": {}, "previous_attributes": 1}}',
+        ):
+            with self.subTest(body=body):
+                with self.assertRaises(ValueError):
+                    eventmodel.StripeEvent.from_json(body)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,100 @@
+import os
+import tempfile
+import unittest
+
+import historymodel
+
+class EventHistoryTest(unittest.TestCase):
+    def test_abstract(self):
+        with self.assertRaises(TypeError):
+            historymodel.EventHistory() # type: ignore
+
+class MemoryEventHistoryTest(unittest.TestCase):
+    def test_duplicate(self):
+        history = historymodel.MemoryEventHistory()
+        self.assertTrue(history.add("evt_1"))
+        self.assertFalse(history.add("evt_1"))
+        self.assertIn("evt_1", history)
+        history.discard("evt_1")
+        self.assertNotIn("evt_1", history)
+        self.assertTrue(history.add("evt_1"))
+
+    def test_expired(self):
+        history = historymodel.MemoryEventHistory(ttl=-1)
+        self.assertTrue(history.add("evt_1"))
+        self.assertNotIn("evt_1", history)
+        self.assertTrue(history.add("evt_1"))
+        self.assertEqual(len(history), 1)
+
+    def test_least_recently_seen_evicted(self):
+        history = historymodel.MemoryEventHistory(max_size=2)
+        history.add("evt_1")
+        history.add("evt_2")
+        self.assertFalse(history.add("evt_1")) # A resend makes evt_1 the most recent
+        history.add("evt_3")
+        self.assertEqual(len(history), 2)
+        self.assertIn("evt_1", history)
+        self.assertNotIn("evt_2", history)
+
+class SQLiteEventHistoryTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "test.db")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def open(self, **kwargs) -> historymodel.SQLiteEventHistory:
+        history = historymodel.SQLiteEventHistory(self.path, **kwargs)
+        self.addCleanup(history.close)
+        return history
+
+    def test_survives_restart(self):
+        history = historymodel.SQLiteEventHistory(self.path)
+        self.assertTrue(history.add("evt_1"))
+        history.complete("evt_1")
+        history.close()
+        history = self.open()
+        self.assertIn("evt_1", history)
+        self.assertFalse(history.add("evt_1"))
+
+    def test_expired(self):
+        history = self.open()
+        self.assertTrue(history.add("evt_1"))
+        history.complete("evt_1")
+        history = self.open(ttl=-1) # As if evt_1 was recorded longer than the TTL ago
+        self.assertNotIn("evt_1", history)
+        self.assertTrue(history.add("evt_1")) # Takes over the row that was not pruned yet
+        self.assertEqual(history.prune(), 1)
+
+    def test_cache_evicts_least_recently_seen(self):
+        history = self.open(cache_size=1)
+        history.add("evt_1")
+        history.add("evt_2")
+        self.assertNotIn("evt_1", history._cache)
+        self.assertIn("evt_1", history) # Still in the database
+        self.assertFalse(history.add("evt_1"))
+
+    def test_discarded_by_other_worker(self):
+        a, b = self.open(), self.open()
+        self.assertTrue(a.add("evt_1"))
+        self.assertFalse(b.add("evt_1")) # Still processed by a
+        a.discard("evt_1") # ...which failed
+        self.assertTrue(b.add("evt_1")) # Stripe's retry is processed
+
+    def test_abandoned_by_other_worker(self):
+        a, b = self.open(), self.open()
+        self.assertTrue(a.add("evt_1"))
+        self.assertFalse(b.add("evt_1"))
+        b.processing_timeout = 0 # a has not completed it in time
+        self.assertTrue(b.add("evt_1"))
+
+    def test_completed_by_other_worker(self):
+        a, b = self.open(processing_timeout=0), self.open(processing_timeout=0)
+        self.assertTrue(a.add("evt_1"))
+        a.complete("evt_1")
+        self.assertFalse(b.add("evt_1"))
+        self.assertIn("evt_1", b._cache)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,73 @@
+import os
+import tempfile
+import unittest
+
+import metricsmodel
+
+class SharedMetricsTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "test.db")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def open(self, worker: str, registry: list) -> metricsmodel.SharedMetrics:
+        metrics = metricsmodel.SharedMetrics(self.path, worker, registry=registry)
+        self.addCleanup(metrics.close)
+        return metrics
+
+    def registry(self) -> tuple[list, metricsmodel.Counter, metricsmodel.Histogram]:
+        counter = metricsmodel.Counter("test_events_total", "Events", ("type",))
+        histogram = metricsmodel.Histogram("test_seconds", "Seconds", buckets=(1,))
+        gauge = metricsmodel.Gauge("test_queue_depth", "Depth", lambda: 3)
+        for metric in (counter, histogram, gauge):
+            metricsmodel.REGISTRY.remove(metric)
+        return [counter, histogram, gauge], counter, histogram
+
+    def test_scrape_includes_every_worker(self):
+        registry_a, counter_a, histogram_a = self.registry()
+        registry_b, counter_b, _ = self.registry()
+        a, b = self.open("Sanic-Server-0-0", registry_a), self.open("Sanic-Server-1-0", registry_b)
+        counter_a.inc("checkout")
+        histogram_a.observe(0.5)
+        counter_b.inc("checkout", amount=2)
+        b.publish()
+        body = a.render()
+        self.assertEqual(body.count("# TYPE test_events_total counter"), 1) # One family for both workers
+        self.assertIn('test_events_total{worker="Sanic-Server-0-0",type="checkout"} 1\n', body)
+        self.assertIn('test_events_total{worker="Sanic-Server-1-0",type="checkout"} 2\n', body)
+        self.assertIn('test_seconds_bucket{worker="Sanic-Server-0-0",le="1"} 1\n', body)
+        self.assertIn('test_seconds_sum{worker="Sanic-Server-0-0"} 0.5\n', body)
+        self.assertIn('test_queue_depth{worker="Sanic-Server-1-0"} 3\n', body)
+
+    def test_stale_worker_dropped(self):
+        registry_a, _, _ = self.registry()
+        registry_b, counter_b, _ = self.registry()
+        a, b = self.open("Sanic-Server-0-0", registry_a), self.open("Sanic-Server-1-0", registry_b)
+        counter_b.inc("checkout")
+        b.publish()
+        a.ttl = -1 # b stopped publishing
+        self.assertNotIn("Sanic-Server-1-0", a.render())
+
+    def test_render_without_workers(self):
+        registry, counter, histogram = self.registry()
+        counter.inc("checkout")
+        histogram.observe(2)
+        self.assertEqual(metricsmodel.render(registry), "\n".join((
+            "# HELP test_events_total Events",
+            "# TYPE test_events_total counter",
+            'test_events_total{type="checkout"} 1',
+            "# HELP test_seconds Seconds",
+            "# TYPE test_seconds histogram",
+            'test_seconds_bucket{le="1"} 0',
+            'test_seconds_bucket{le="+Inf"} 1',
+            "test_seconds_sum 2",
+            "test_seconds_count 1",
+            "# HELP test_queue_depth Depth",
+            "# TYPE test_queue_depth gauge",
+            "test_queue_depth 3",
+        )) + "\n")
+
+if __name__ == "__main__":
+    unittest.main()
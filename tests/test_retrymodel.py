@@ -0,0 +1,65 @@
+import asyncio
+import os
+import tempfile
+import unittest
+
+import retrymodel
+import workermodel
+
+class SupersedeTest(unittest.IsolatedAsyncioTestCase):
+    """A retry that waits behind a newer event must apply what is left of it after that event"""
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.queue = retrymodel.RetryQueue(os.path.join(self.directory.name, "test.db"), drain_rate=100)
+        self.executor = workermodel.KeyedExecutor(concurrency=4)
+        self.applied: list[str] = []
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    async def event(self, add: list[str], remove: list[str]) -> None:
+        await asyncio.sleep(0.05) # Still running when the retry is submitted
+        self.queue.supersede("42", add, remove)
+        self.applied += [f"+{r}" for r in add] + [f"-{r}" for r in remove]
+
+    async def apply(self, job: dict) -> str | None:
+        current = self.queue.pending(job["id"])
+        if current is None:
+            return None
+        self.applied += [f"+{r}" for r in current["add_roles"]] + [f"-{r}" for r in current["remove_roles"]]
+        return None
+
+    async def retry(self, job: dict) -> str | None:
+        future = self.executor.submit(job["key"], 1, lambda: self.apply(job))
+        if future is None:
+            raise retrymodel.Deferred("Executor is full")
+        return await future
+
+    async def run_retries(self, job_id: int, add: list[str], remove: list[str]) -> None:
+        self.queue._db.execute("UPDATE role_jobs SET next_run_at = 0 WHERE id = ?", (job_id,))
+        self.executor.submit("cus_1", 0, lambda: self.event(add, remove)) # A newer event of the customer, queued first
+        runner = asyncio.create_task(self.queue.run(self.retry, poll_interval=0.01))
+        await asyncio.sleep(0.3)
+        runner.cancel()
+        await asyncio.gather(runner, return_exceptions=True)
+        await self.executor.close()
+
+    async def test_superseded(self):
+        job_id = self.queue.push("cus_1", "42", ["111"], [], "test")
+        await self.run_retries(job_id, [], ["111"])
+        self.assertEqual(self.applied, ["-111"])
+        self.assertIsNone(self.queue.get(job_id))
+
+    async def test_trimmed(self):
+        job_id = self.queue.push("cus_1", "42", ["111", "222"], [], "test")
+        await self.run_retries(job_id, [], ["111"])
+        self.assertEqual(self.applied, ["-111", "+222"])
+        self.assertIsNone(self.queue.get(job_id))
+
+    async def test_not_superseded(self):
+        job_id = self.queue.push("cus_1", "42", ["111"], [], "test")
+        await self.run_retries(job_id, ["222"], [])
+        self.assertEqual(self.applied, ["+222", "+111"])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,84 @@
+import json
+import logging
+import os
+import sqlite3
+from typing import Iterator
+
+class UserData:
+    """Stripe Customer -> Discord User map for dinosaur-stripeconnect
+
+    Stored in SQLite (WAL mode), so every checkout is a single upsert instead of
+    rewriting the whole map, and nothing is loaded into memory at startup."""
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS userdata (customer TEXT PRIMARY KEY, user_id TEXT NOT NULL) WITHOUT ROWID")
+        self._db.execute("CREATE INDEX IF NOT EXISTS userdata_user_id ON userdata (user_id)")
+
+    def __contains__(self, customer: str) -> bool:
+        return self.get(customer) is not None
+
+    def __getitem__(self, customer: str) -> str:
+        user_id = self.get(customer)
+        if user_id is None:
+            raise KeyError(customer)
+        return user_id
+
+    def __setitem__(self, customer: str, user_id: str | int) -> None:
+        self._db.execute(
+            "INSERT INTO userdata (customer, user_id) VALUES (?, ?) ON CONFLICT (customer) DO UPDATE SET user_id = excluded.user_id",
+            (customer, str(user_id)),
+        )
+
+    def __len__(self) -> int:
+        return self._db.execute("SELECT COUNT(*) FROM userdata").fetchone()[0]
+
+    def get(self, customer: str, default: str | None = None) -> str | None:
+        row = self._db.execute("SELECT user_id FROM userdata WHERE customer = ?", (customer,)).fetchone()
+        return row[0] if row else default
+
+    def customers_of(self, user_id: str | int) -> list[str]:
+        """Reverse lookup: Stripe Customers linked to a Discord User"""
+        return [row[0] for row in self._db.execute("SELECT customer FROM userdata WHERE user_id = ?", (str(user_id),))]
+
+    def has_user(self, user_id: str | int) -> bool:
+        return self._db.execute("SELECT 1 FROM userdata WHERE user_id = ? LIMIT 1", (str(user_id),)).fetchone() is not None
+
+    def items(self) -> Iterator[tuple[str, str]]:
+        """Iterate over (customer, user_id) without loading the whole map"""
+        yield from self._db.execute("SELECT customer, user_id FROM userdata")
+
+    def user_ids(self) -> Iterator[str]:
+        """Iterate over the distinct Discord Users"""
+        for row in self._db.execute("SELECT DISTINCT user_id FROM userdata"):
+            yield row[0]
+
+    def import_json(self, path: str) -> int:
+        """Import a legacy `userdata` JSON file (renamed to `<path>.migrated` afterwards)"""
+        try:
+            with open(path, "r") as f:
+                data: dict[str, str] = json.loads(f.read() or "{}")
+        except FileNotFoundError:
+            return 0
+        self._db.execute("BEGIN")
+        try:
+            self._db.executemany(
+                "INSERT OR IGNORE INTO userdata (customer, user_id) VALUES (?, ?)",
+                ((customer, str(user_id)) for customer, user_id in data.items()),
+            )
+        except BaseException:
+            self._db.execute("ROLLBACK")
+            raise
+        self._db.execute("COMMIT")
+        os.replace(path, f"{path}.migrated")
+        logging.info("Imported %d customers from %s", len(data), path)
+        return len(data)
+
+    def compact(self) -> None:
+        """Checkpoint the WAL into the database file and truncate it"""
+        self._db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def close(self) -> None:
+        self._db.close()
@@ -0,0 +1,191 @@
+import asyncio
+import contextlib
+import heapq
+import itertools
+import logging
+import os
+import sqlite3
+import time
+from typing import Any, AsyncIterator, Awaitable, Callable
+
+try:
+    import fcntl
+except ImportError: # Windows: a single worker is the only option there
+    fcntl = None
+
+Job = Callable[[], Awaitable[Any]]
+
+class KeyedExecutor:
+    """Keyed asyncio executor for dinosaur-stripeconnect
+
+    Jobs with the same key (e.g. a Stripe Customer) run one at a time in `order`
+    (e.g. the event's `created` timestamp), while jobs with different keys run in
+    parallel, up to `concurrency` at once."""
+    def __init__(self, concurrency: int = 4, max_pending: int = 1000, window: float = 0.0, lease: "KeyLease | None" = None) -> None:
+        self.concurrency = max(1, concurrency) # Max jobs running at once
+        self.max_pending = max(1, max_pending) # Max pending jobs before push back
+        self.window = window # Seconds to wait for more jobs of a key before running them in order
+        self.lease = lease # Also run one job per key at a time across processes
+        self._heaps: dict[str, list[tuple[float, int, Job, asyncio.Future]]] = {} # key -> pending jobs
+        self._runners: dict[str, asyncio.Task] = {}
+        self._semaphore: asyncio.Semaphore | None = None
+        self._sequence = itertools.count() # Keeps submission order for equal `order`
+        self._pending = 0
+
+    @property
+    def depth(self) -> int:
+        """Number of jobs waiting or running"""
+        return self._pending
+
+    def submit(self, key: str, order: float, job: Job) -> asyncio.Future | None:
+        """Queue a job. Returns a future of its result, or None if the executor is saturated"""
+        if self._pending >= self.max_pending:
+            logging.warning("Executor is full (depth: %d)", self._pending)
+            return None
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._heaps.setdefault(key, []), (order, next(self._sequence), job, future))
+        self._pending += 1
+        if key not in self._runners:
+            self._runners[key] = asyncio.create_task(self._run(key))
+        return future
+
+    async def close(self, timeout: float = 10) -> None:
+        """Wait for pending jobs (up to timeout) and cancel the rest"""
+        runners = list(self._runners.values())
+        if not runners:
+            return
+        _, still_running = await asyncio.wait(runners, timeout=timeout)
+        if still_running:
+            logging.warning("Executor closed with %d pending jobs", self._pending)
+        for runner in still_running:
+            runner.cancel()
+        await asyncio.gather(*still_running, return_exceptions=True)
+
+    async def _run(self, key: str) -> None:
+        assert self._semaphore is not None
+        heap = self._heaps[key]
+        try:
+            if self.window > 0:
+                await asyncio.sleep(self.window)
+            while heap:
+                _, _, job, future = heapq.heappop(heap)
+                try:
+                    if self.lease is not None:
+                        await self.lease.acquire(key)
+                    try:
+                        async with self._semaphore:
+                            result = await job()
+                    finally:
+                        if self.lease is not None:
+                            self.lease.release(key)
+                except asyncio.CancelledError:
+                    future.cancel()
+                    raise
+                except Exception as e:
+                    if not future.done():
+                        future.set_exception(e)
+                else:
+                    if not future.done():
+                        future.set_result(result)
+                finally:
+                    self._pending -= 1
+        finally:
+            for _, _, _, future in heap:
+                future.cancel()
+            self._pending -= len(heap)
+            del self._heaps[key]
+            del self._runners[key]
+
+class KeyLease:
+    """Cross-process lock per key through SQLite
+
+    Leases expire after `ttl` seconds, so a key held by a crashed process is freed."""
+    def __init__(self, path: str, ttl: float = 300, poll_interval: float = 0.05) -> None:
+        self.path = path
+        self.ttl = ttl # Seconds before a lease of a dead holder can be taken over
+        self.poll_interval = poll_interval # Seconds between attempts while a key is held
+        self.owner = str(os.getpid())
+        self._db = sqlite3.connect(path, isolation_level=None, check_same_thread=False, timeout=5)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS key_leases (key TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL) WITHOUT ROWID")
+
+    def try_acquire(self, key: str) -> bool:
+        now = time.time()
+        cursor = self._db.execute(
+            "INSERT INTO key_leases (key, owner, expires_at) VALUES (?, ?, ?) "
+            "ON CONFLICT (key) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at WHERE expires_at < ?",
+            (key, self.owner, now + self.ttl, now),
+        )
+        return cursor.rowcount > 0
+
+    async def acquire(self, key: str) -> None:
+        while not self.try_acquire(key):
+            await asyncio.sleep(self.poll_interval)
+
+    def release(self, key: str) -> None:
+        self._db.execute("DELETE FROM key_leases WHERE key = ? AND owner = ?", (key, self.owner))
+
+class KeyLock:
+    """Lock per key (e.g. a Discord member), also across processes with a KeyLease
+
+    Unlike the KeyedExecutor, which orders the jobs of one key, this guards a short
+    critical section shared by jobs of different keys."""
+    def __init__(self, lease: KeyLease | None = None) -> None:
+        self.lease = lease
+        self._locks: dict[str, tuple[asyncio.Lock, int]] = {} # key -> (lock, holders and waiters)
+
+    @contextlib.asynccontextmanager
+    async def hold(self, key: str) -> AsyncIterator[None]:
+        lock, users = self._locks.get(key) or (asyncio.Lock(), 0)
+        self._locks[key] = (lock, users + 1)
+        try:
+            async with lock:
+                if self.lease is not None:
+                    await self.lease.acquire(key)
+                try:
+                    yield
+                finally:
+                    if self.lease is not None:
+                        self.lease.release(key)
+        finally:
+            lock, users = self._locks[key]
+            if users > 1:
+                self._locks[key] = (lock, users - 1)
+            else:
+                del self._locks[key]
+
+class LeaderLock:
+    """Elects one process (e.g. of the Sanic workers) to run the singleton background tasks
+
+    Holds an exclusive `flock` on `path` for the lifetime of the process. The OS releases
+    it when the leader exits or crashes, and a waiting process takes over."""
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._file = None
+
+    @property
+    def is_leader(self) -> bool:
+        return self._file is not None
+
+    def try_acquire(self) -> bool:
+        if self._file is not None:
+            return True
+        if fcntl is None:
+            self._file = True # No other process to compete with
+            return True
+        file = open(self.path, "a")
+        try:
+            fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            file.close()
+            return False
+        self._file = file
+        return True
+
+    async def wait(self, interval: float = 5) -> None:
+        """Return once this process is the leader"""
+        while not self.try_acquire():
+            await asyncio.sleep(interval)